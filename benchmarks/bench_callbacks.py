@@ -0,0 +1,195 @@
+"""Benchmark the explorer callbacks on synthetic corpora.
+
+Every corpus size is written once as an embedding store and benchmarked in a
+fresh process, so module level work in main.py is measured as well. The
+callbacks are called through the Flask test client with the same payloads the
+browser sends, which includes Dash's serialisation of the output and its
+compression. The figure cache is turned off, so repeated page renders time the
+callback rather than a cache hit.
+
+    python benchmarks/bench_callbacks.py --sizes 1000 100000 1000000 --output results.json
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import knn_graph  # noqa: E402
+from figure_cache import build_request_body  # noqa: E402
+
+
+def generate_store(path, n_rows, n_pages, n_dims, text_length, seed=0):
+    """Write a synthetic corpus: clustered vectors, pages and random texts."""
+    from embedding_store import EmbeddingStore, make_text_ids
+    from similarity import normalize_rows
+    from text_index import TextIndex
+
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, min(100, n_rows // 100))
+    centers = rng.normal(size=(n_clusters, n_dims)).astype(np.float32)
+    vectors = centers[rng.integers(0, n_clusters, n_rows)] + 0.3 * rng.normal(size=(n_rows, n_dims)).astype(np.float32)
+    pages = np.sort(rng.integers(1, n_pages + 1, n_rows))
+    coordinates = vectors[:, :3] if n_dims >= 3 else np.pad(vectors, ((0, 0), (0, 3 - n_dims)))
+
+    words = np.array(['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta'])
+    n_words = max(1, text_length // 6)
+    texts = [' '.join(words[rng.integers(0, len(words), n_words)]) for _ in range(n_rows)]
+
+    EmbeddingStore(coordinates, normalize_rows(vectors), pages, make_text_ids(pages), texts).save(path)
+    TextIndex.build(texts).save(path)
+
+
+def server_requests(app, prop):
+    """Number of server callbacks an interaction changing ``prop`` can chain into.
+
+    Clientside callbacks are followed but not counted since they don't make a
+    request. This is an upper bound, callbacks returning no_update end a chain.
+    """
+    changed, seen, requests = {prop}, set(), 0
+    while True:
+        triggered = [i for i, callback in enumerate(app._callback_list)
+                     if i not in seen and any(f"{d['id']}.{d['property']}" in changed for d in callback['inputs'])]
+        if not triggered:
+            return requests
+        for i in triggered:
+            seen.add(i)
+            callback = app._callback_list[i]
+            if not callback.get('clientside_function'):
+                requests += 1
+            changed.update(output.split('@')[0] for output in callback['output'].strip('.').split('...'))
+
+
+def percentiles(samples):
+    samples = np.asarray(samples)
+    return {'p50': float(np.percentile(samples, 50)), 'p90': float(np.percentile(samples, 90)),
+            'p99': float(np.percentile(samples, 99)), 'max': float(samples.max()), 'count': len(samples)}
+
+
+def max_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_worker(repeat, seed=0):
+    """Import main.py (EXPLORER_DATA must point at a store) and time every scenario."""
+    start = time.perf_counter()
+    import main
+    import_seconds = time.perf_counter() - start
+    import_rss = max_rss_bytes()
+
+    app = main.app
+    client = app.server.test_client()
+    rng = np.random.default_rng(seed)
+    first_page = int(main.page_index.pages[0])
+
+    def point(row):
+        x, y, z = (float(v) for v in main.coordinates[row])
+        return {'x': x, 'y': y, 'z': z, 'pointNumber': 0, 'curveNumber': 0, 'customdata': int(row)}
+
+    def camera(distance):
+        return {'scene.camera': {'eye': {'x': distance, 'y': distance, 'z': distance},
+                                 'center': {'x': 0, 'y': 0, 'z': 0}, 'up': {'x': 0, 'y': 0, 'z': 1}}}
+
+    base = {'tooltip-toggle.value': [], 'similarity-threshold.value': main.n}
+    scenarios = {
+        'initial_render': lambda row: ('scatter-plot.figure', {}, []),
+        'page_render': lambda row: ('scatter-plot.figure', {'page-input.value': first_page}, ['page-input.value']),
+        'tooltip_toggle': lambda row: ('scatter-plot.figure', {'tooltip-toggle.value': ['show-text']},
+                                       ['tooltip-toggle.value']),
+        'click': lambda row: ('clicked-point-output.children', {'scatter-plot.clickData': {'points': [point(row)]}},
+                              ['scatter-plot.clickData']),
+        'hover': lambda row: ('hovered-point-output.children', {'scatter-plot.hoverData': {'points': [point(row)]}},
+                              ['scatter-plot.hoverData']),
+        'search': lambda row: ('search-output.children', {'search-input.value': str(main.texts[row]).split()[0],
+                                                          'page-input.value': first_page}, ['search-input.value']),
+        'camera_zoom': lambda row: ('scatter-plot.figure', {'plot-state.data': camera(rng.choice([2.0, 0.5, 0.1]))},
+                                    ['plot-state.data']),
+    }
+
+    results = {'n_rows': main.n_rows, 'import_seconds': import_seconds, 'import_max_rss_bytes': import_rss,
+               'requests_per_interaction': {
+                   name: server_requests(app, prop) for name, prop in [
+                       ('click', 'scatter-plot.clickData'), ('hover', 'scatter-plot.hoverData'),
+                       ('camera', 'scatter-plot.relayoutData'), ('tooltip', 'tooltip-toggle.value')]},
+               'scenarios': {}}
+    for name, scenario in scenarios.items():
+        seconds, sizes, statuses = [], [], set()
+        for _ in range(repeat):
+            output, values, changed = scenario(int(rng.integers(0, main.n_rows)))
+            body = build_request_body(app, output, {**base, **values}, changed)
+            start = time.perf_counter()
+            response = client.post('/_dash-update-component', json=body, headers={'Accept-Encoding': 'gzip'})
+            seconds.append(time.perf_counter() - start)
+            sizes.append(len(response.data))
+            statuses.add(response.status_code)
+        results['scenarios'][name] = {'seconds': percentiles(seconds), 'bytes': percentiles(sizes),
+                                      'status': sorted(statuses)}
+
+    results['max_rss_bytes'] = max_rss_bytes()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--dims', type=int, default=3)
+    parser.add_argument('--text-length', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--knn', type=int, default=0, help='build a neighbour graph with this many neighbours')
+    parser.add_argument('--quantize', choices=['float16', 'int8'], help='scan a quantised copy of the vectors')
+    parser.add_argument('--data-dir', help='where generated stores are kept, reused between runs')
+    parser.add_argument('--output', help='json file for the results, stdout when omitted')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        json.dump(run_worker(args.repeat), sys.stdout)
+        return
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='explorer-bench-')
+    runs = []
+    for n_rows in args.sizes:
+        store = os.path.join(data_dir, f'n{n_rows}_p{args.pages}_d{args.dims}_t{args.text_length}_k{args.knn}')
+        if args.quantize:
+            store += f'_{args.quantize}'
+        if not os.path.exists(os.path.join(store, 'texts.bin')):
+            generate_store(store, n_rows, args.pages, args.dims, args.text_length)
+            if args.knn:
+                knn_graph.build(store, args.knn)
+            if args.quantize:
+                from embedding_store import EmbeddingStore
+                EmbeddingStore.open(store).quantize(args.quantize)
+
+        worker = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', store, '--repeat', str(args.repeat)],
+            # background jobs are answered asynchronously, time the callbacks in the request instead
+            env={**os.environ, 'EXPLORER_DATA': store, 'EXPLORER_BACKGROUND_MIN_ROWS': str(2 ** 62),
+                 # indexes are loaded before the first callback is timed, bench_startup.py times that
+                 'EXPLORER_STARTUP': 'eager', 'EXPLORER_FIGURE_CACHE_BYTES': '0'}, cwd=repo_root, capture_output=True, text=True, check=True)
+        result = json.loads(worker.stdout)
+        result.update(pages=args.pages, dims=args.dims, text_length=args.text_length, knn=args.knn,
+                      quantize=args.quantize)
+        runs.append(result)
+        print(f"{n_rows} rows: " + ', '.join(
+            f"{name} p50 {s['seconds']['p50'] * 1000:.1f} ms" for name, s in result['scenarios'].items()),
+            file=sys.stderr)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'runs': runs}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Compare figure payload encodings for one page of the explorer.
+
+    python benchmarks/bench_encoding.py --points 500000 --output encoding.json
+
+Both figures are serialised with ``dash._utils.to_json``, as Dash does for a
+callback response. ``numpy_arrays`` is the figure main.py used to build
+(numpy columns in a graph object figure, which plotly encodes as float64 /
+int64 typed arrays), ``typed_arrays`` is what it sends now (float32
+coordinates, smallest int page colours, customdata as a JSON list of row ids
+so it reaches click events, the page is read from the colour). Text columns are left out since they are encoded the
+same way in both.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from dash._utils import to_json
+from plotly import graph_objects as go
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from encoding import smallest_int_dtype, typed_array, with_customdata  # noqa: E402
+
+
+def numpy_arrays_figure(coordinates, pages, rows):
+    return go.Figure(go.Scatter3d(
+        x=coordinates[:, 0],
+        y=coordinates[:, 1],
+        z=coordinates[:, 2],
+        marker_color=pages,
+        customdata=np.column_stack((rows, pages)),
+    ))
+
+
+def typed_arrays_figure(coordinates, pages, rows):
+    trace = go.Scatter3d(
+        x=typed_array(coordinates[:, 0], np.float32),
+        y=typed_array(coordinates[:, 1], np.float32),
+        z=typed_array(coordinates[:, 2], np.float32),
+        marker_color=typed_array(pages, smallest_int_dtype(pages)),
+    )
+    return {'data': [with_customdata(trace, rows)]}
+
+
+def measure(build, repeat):
+    encode_seconds, decode_seconds = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = to_json(build())
+        encode_seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        json.loads(payload)
+        decode_seconds.append(time.perf_counter() - start)
+    return {'bytes': len(payload), 'encode_seconds': float(np.median(encode_seconds)),
+            'decode_seconds': float(np.median(decode_seconds))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=500000)
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='json file for the results, stdout when omitted')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    coordinates = rng.normal(size=(args.points, 3))
+    pages = np.sort(rng.integers(1, args.pages + 1, args.points))
+    rows = np.arange(args.points)
+
+    report = {
+        'points': args.points,
+        'numpy_arrays': measure(lambda: numpy_arrays_figure(coordinates, pages, rows), args.repeat),
+        'typed_arrays': measure(lambda: typed_arrays_figure(coordinates, pages, rows), args.repeat),
+    }
+    report['size_ratio'] = report['numpy_arrays']['bytes'] / report['typed_arrays']['bytes']
+
+    print(f"numpy arrays: {report['numpy_arrays']['bytes'] / 1e6:.1f} MB in "
+          f"{report['numpy_arrays']['encode_seconds'] * 1000:.0f} ms, typed arrays: "
+          f"{report['typed_arrays']['bytes'] / 1e6:.1f} MB in {report['typed_arrays']['encode_seconds'] * 1000:.0f} ms",
+          file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
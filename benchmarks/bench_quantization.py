@@ -0,0 +1,89 @@
+"""Compare float32, float16 and int8 similarity scans on a synthetic corpus.
+
+    python benchmarks/bench_quantization.py --rows 1000000 --dims 768 --output quantization.json
+
+The full precision vectors are written to a .npy file and memory mapped, as
+in an embedding store. Quantised scans only read the float32 rows of their
+candidates for the exact re-rank. ``scan_bytes`` is the memory a full scan
+touches, ``recall`` the fraction of the exact top k found.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import similarity  # noqa: E402
+from similarity import QuantizedVectors, SimilarityEngine, normalize_rows  # noqa: E402
+
+
+def write_vectors(path, n_rows, n_dims, seed=0, batch_size=65536):
+    """Clustered unit length vectors, written one batch at a time."""
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, min(1000, n_rows // 100))
+    centers = rng.normal(size=(n_clusters, n_dims)).astype(np.float32)
+    vectors = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_rows, n_dims))
+    for start in range(0, n_rows, batch_size):
+        size = min(batch_size, n_rows - start)
+        batch = centers[rng.integers(0, n_clusters, size)] + rng.normal(size=(size, n_dims)).astype(np.float32)
+        vectors[start:start + size] = normalize_rows(batch)
+    vectors.flush()
+
+
+def measure(engine, queries, k, exact):
+    seconds, recalls = [], []
+    for row, expected in zip(queries, exact):
+        start = time.perf_counter()
+        indices, _ = engine.top_k(row, k)
+        seconds.append(time.perf_counter() - start)
+        recalls.append(len(np.intersect1d(indices, expected)) / k)
+    return {'p50_seconds': float(np.percentile(seconds, 50)), 'recall': float(np.mean(recalls)),
+            'min_recall': float(np.min(recalls))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--dims', type=int, default=384)
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--data-dir', help='where the vectors are written, reused between runs')
+    parser.add_argument('--output', help='json file for the results, stdout when omitted')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='explorer-bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f'vectors_n{args.rows}_d{args.dims}.npy')
+    if not os.path.exists(path):
+        write_vectors(path, args.rows, args.dims)
+    vectors = np.load(path, mmap_mode='r')
+    queries = np.random.default_rng(1).choice(args.rows, args.queries, replace=False)
+
+    exact_engine = SimilarityEngine(vectors, normalized=True)
+    exact = [exact_engine.top_k(row, args.k)[0] for row in queries]
+
+    report = {'rows': args.rows, 'dims': args.dims, 'k': args.k, 'rerank_factor': similarity.rerank_factor,
+              'float32': {'scan_bytes': vectors.nbytes, **measure(exact_engine, queries, args.k, exact)}}
+    for dtype in ('float16', 'int8'):
+        quantized = QuantizedVectors.from_vectors(vectors, dtype)
+        engine = SimilarityEngine(vectors, normalized=True, quantized=quantized)
+        report[dtype] = {'scan_bytes': quantized.nbytes, 'memory_ratio': vectors.nbytes / quantized.nbytes,
+                         **measure(engine, queries, args.k, exact)}
+
+    print(', '.join(f"{name}: {report[name]['scan_bytes'] / 1e6:.0f} MB, "
+                    f"p50 {report[name]['p50_seconds'] * 1000:.1f} ms, recall@{args.k} {report[name]['recall']:.3f}"
+                    for name in ('float32', 'float16', 'int8')), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
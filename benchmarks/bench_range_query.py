@@ -0,0 +1,89 @@
+"""Time score cutoff queries with the approximate index and check them against a full scan.
+
+    python benchmarks/bench_range_query.py --rows 60000 --dims 8 --min-score 0.9
+
+``range_query`` promises the same rows as a brute force scan (up to
+``--max-results``) with or without the approximate index, and with or without
+a scope. ``missed`` counts the true matches a query left out, the script exits
+with status 1 when any query missed one.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_quantization import write_vectors  # noqa: E402
+from similarity import SimilarityEngine  # noqa: E402
+
+
+def brute_force(vectors, row, min_score, max_results, rows):
+    """Rows of ``rows`` (all when None) scoring at least ``min_score``, best first and capped."""
+    candidates = np.arange(len(vectors)) if rows is None else np.arange(len(vectors))[rows]
+    candidates = candidates[candidates != row]
+    scores = np.asarray(vectors[candidates]) @ np.asarray(vectors[row])
+    order = np.argsort(-scores, kind='stable')[:max_results]
+    order = order[scores[order] >= min_score]
+    return candidates[order], scores[order]
+
+
+def measure(engine, vectors, queries, min_score, max_results, rows):
+    seconds, missed, results = [], [], []
+    for row in queries:
+        start = time.perf_counter()
+        indices, _ = engine.range_query(row, min_score, max_results, rows=rows)
+        seconds.append(time.perf_counter() - start)
+        expected, expected_scores = brute_force(vectors, row, min_score, max_results, rows)
+        # rows tied with the last one kept by the cap may be swapped for each other
+        tied = expected_scores >= expected_scores[-1] + 1e-6 if len(expected) == max_results else slice(None)
+        missed.append(len(np.setdiff1d(expected[tied], indices)))
+        results.append(len(expected))
+    return {'p50_seconds': float(np.percentile(seconds, 50)), 'mean_results': float(np.mean(results)),
+            'queries_missing_rows': int(np.count_nonzero(missed)), 'max_missed': int(np.max(missed))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=60000)
+    parser.add_argument('--dims', type=int, default=8)
+    parser.add_argument('--min-score', type=float, default=0.9)
+    parser.add_argument('--max-results', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--data-dir', help='where the vectors are written, reused between runs')
+    parser.add_argument('--output', help='json file for the results, stdout when omitted')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='explorer-bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f'vectors_n{args.rows}_d{args.dims}.npy')
+    if not os.path.exists(path):
+        write_vectors(path, args.rows, args.dims)
+    vectors = np.load(path, mmap_mode='r')
+    queries = np.random.default_rng(1).choice(args.rows, args.queries, replace=False)
+
+    engine = SimilarityEngine(vectors, n_lists=int(np.sqrt(args.rows)), normalized=True)
+    scopes = {'all': None, 'half': slice(0, args.rows // 2),
+              'every_third': np.arange(0, args.rows, 3)}
+    report = {'rows': args.rows, 'dims': args.dims, 'min_score': args.min_score, 'max_results': args.max_results,
+              'scopes': {name: measure(engine, vectors, queries, args.min_score, args.max_results, rows)
+                         for name, rows in scopes.items()}}
+
+    print(', '.join(f"{name}: p50 {result['p50_seconds'] * 1000:.1f} ms, "
+                    f"{result['queries_missing_rows']} of {args.queries} queries missed rows"
+                    for name, result in report['scopes'].items()), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    if any(result['queries_missing_rows'] for result in report['scopes'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Measure how fast main.py starts answering on a synthetic corpus.
+
+    python benchmarks/bench_startup.py --rows 400000 --dims 64 --output startup.json
+
+Every startup mode (see ``EXPLORER_STARTUP`` in main.py) is run in a fresh
+process twice: cold, with no text or similarity index saved next to the store,
+and warm, with the indexes the cold run saved. ``import_seconds`` is the time
+to import main.py, ``first_response_seconds`` adds the first layout request
+and the first base figure; the first click and search are timed as well since
+a lazily loaded index is paid for there. ``slowest_imports`` comes from
+``python -X importtime``.
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+from bench_callbacks import generate_store  # noqa: E402
+
+index_files = ['search_*', 'ivf_*.npy']
+
+
+def run_worker():
+    """Import main.py (EXPLORER_DATA must point at a store) and time the first requests."""
+    start = time.perf_counter()
+    import main
+    from figure_cache import build_request_body
+    timings = {'import_seconds': time.perf_counter() - start}
+
+    app = main.app
+    client = app.server.test_client()
+    row = int(np.random.default_rng(0).integers(0, main.n_rows))
+    point = {'x': 0, 'y': 0, 'z': 0, 'pointNumber': 0, 'curveNumber': 0, 'customdata': row}
+    requests = [
+        ('layout', None),
+        ('base_figure', ('scatter-plot.figure', {'tooltip-toggle.value': []}, [])),
+        ('click', ('clicked-point-output.children', {'scatter-plot.clickData': {'points': [point]},
+                                                    'similarity-threshold.value': main.n}, ['scatter-plot.clickData'])),
+        ('search', ('search-output.children', {'search-input.value': str(main.texts[row]).split()[0]},
+                    ['search-input.value'])),
+    ]
+    statuses = {}
+    for name, request in requests:
+        start = time.perf_counter()
+        if request is None:
+            response = client.get('/_dash-layout')
+        else:
+            response = client.post('/_dash-update-component', json=build_request_body(app, *request))
+        timings[f'first_{name}_seconds'] = time.perf_counter() - start
+        statuses[name] = response.status_code
+
+    timings['first_response_seconds'] = (timings['import_seconds'] + timings['first_layout_seconds']
+                                         + timings['first_base_figure_seconds'])
+    return {'n_rows': main.n_rows, **timings, 'status': statuses}
+
+
+def slowest_imports(env, count=10):
+    """Modules with the largest cumulative import time when importing main.py."""
+    worker = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            env=env, cwd=repo_root, capture_output=True, text=True, check=True)
+    modules = []
+    for line in worker.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.removeprefix('import time:').split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            modules.append((int(fields[1]) / 1e6, fields[2].strip()))
+    return [{'module': name, 'cumulative_seconds': seconds} for seconds, name in sorted(modules, reverse=True)[:count]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=400000)
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--dims', type=int, default=64)
+    parser.add_argument('--text-length', type=int, default=100)
+    parser.add_argument('--modes', nargs='+', default=['eager', 'background', 'lazy'])
+    parser.add_argument('--data-dir', help='where the generated store is kept, reused between runs')
+    parser.add_argument('--output', help='json file for the results, stdout when omitted')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        json.dump(run_worker(), sys.stdout)
+        return
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='explorer-bench-')
+    store = os.path.join(data_dir, f'n{args.rows}_p{args.pages}_d{args.dims}_t{args.text_length}')
+    if not os.path.exists(os.path.join(store, 'texts.bin')):
+        generate_store(store, args.rows, args.pages, args.dims, args.text_length)
+
+    runs = []
+    for mode in args.modes:
+        env = {**os.environ, 'EXPLORER_DATA': store, 'EXPLORER_STARTUP': mode,
+               'EXPLORER_BACKGROUND_MIN_ROWS': str(2 ** 62)}
+        for state in ('cold', 'warm'):
+            if state == 'cold':
+                for pattern in index_files:
+                    for path in glob.glob(os.path.join(store, pattern)):
+                        os.remove(path)
+            worker = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker'],
+                                    env=env, cwd=repo_root, capture_output=True, text=True, check=True)
+            result = {'mode': mode, 'state': state, **json.loads(worker.stdout)}
+            runs.append(result)
+            print(f"{mode} {state}: import {result['import_seconds']:.2f} s, "
+                  f"first response {result['first_response_seconds']:.2f} s, "
+                  f"first click {result['first_click_seconds']:.2f} s, "
+                  f"first search {result['first_search_seconds']:.2f} s", file=sys.stderr)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'rows': args.rows, 'dims': args.dims, 'runs': runs,
+              'slowest_imports': slowest_imports({**os.environ, 'EXPLORER_DATA': store, 'EXPLORER_STARTUP': 'lazy'})}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Cluster the vectors of an embedding store with mini-batch k-means.
+
+    python clusters.py STORE_DIR --clusters 1000
+
+Centroids are trained on random batches of the memory mapped vectors and
+every row is then assigned one chunk at a time, so memory stays bounded by the
+batch and chunk sizes. The result is written next to the store as
+``cluster_labels.npy`` (int32, one label per row) and
+``cluster_centroids.npy`` (float32, unit length), and is picked up by
+``EmbeddingStore.open``.
+"""
+import argparse
+import os
+
+import numpy as np
+
+from similarity import normalize_rows
+
+# rows per k-means step
+batch_size = 10000
+# number of k-means steps
+n_steps = 100
+# rows assigned at a time
+chunk_size = 65536
+
+
+def mini_batch_kmeans(vectors, n_clusters, seed=0):
+    """Unit length centroids of ``vectors`` (spherical mini-batch k-means).
+
+    Every centroid moves towards the batch rows assigned to it with a
+    learning rate of one over the number of rows it has seen so far.
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, min(n_clusters, len(vectors)))
+    centroids = normalize_rows(vectors[np.sort(rng.choice(len(vectors), n_clusters, replace=False))])
+    counts = np.zeros(n_clusters, dtype=np.int64)
+
+    for _ in range(n_steps):
+        # sorted reads are much faster on a memory mapped file
+        batch = np.asarray(vectors[np.sort(rng.choice(len(vectors), min(batch_size, len(vectors)), replace=False))],
+                           dtype=np.float32)
+        labels = np.argmax(batch @ centroids.T, axis=1)
+        batch_counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, batch)
+
+        counts += batch_counts
+        moved = batch_counts > 0
+        rate = (batch_counts[moved] / counts[moved])[:, np.newaxis]
+        centroids[moved] = (1 - rate) * centroids[moved] + rate * sums[moved] / batch_counts[moved, np.newaxis]
+        centroids = normalize_rows(centroids)
+    return centroids
+
+
+def assign(vectors, centroids):
+    """Label of the nearest centroid of every row of ``vectors``."""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        labels[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def build(path, n_clusters=1000):
+    """Cluster the store in ``path`` and save its labels and centroids."""
+    vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+    centroids = mini_batch_kmeans(vectors, n_clusters)
+    np.save(os.path.join(path, 'cluster_centroids.npy.tmp.npy'), centroids)
+    np.save(os.path.join(path, 'cluster_labels.npy.tmp.npy'), assign(vectors, centroids))
+    os.replace(os.path.join(path, 'cluster_centroids.npy.tmp.npy'), os.path.join(path, 'cluster_centroids.npy'))
+    os.replace(os.path.join(path, 'cluster_labels.npy.tmp.npy'), os.path.join(path, 'cluster_labels.npy'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('store')
+    parser.add_argument('--clusters', type=int, default=1000)
+    args = parser.parse_args()
+
+    build(args.store, args.clusters)
@@ -0,0 +1,353 @@
+import argparse
+import io
+import os
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows, only the row count check guards concurrent appends there
+    fcntl = None
+
+import clusters
+import projection
+from similarity import QuantizedVectors, normalize_rows, quantize
+
+
+class TextColumn:
+    """Texts stored as one utf-8 blob plus row offsets, decoded on access.
+
+    Both files are memory mapped so only the texts that are read are paged in.
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def open(cls, offsets_path, blob_path):
+        offsets = np.load(offsets_path, mmap_mode='r')
+        if os.path.getsize(blob_path):
+            blob = np.memmap(blob_path, dtype=np.uint8, mode='r')
+        else:
+            blob = np.empty(0, dtype=np.uint8)
+        return cls(offsets, blob)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            return bytes(self.blob[self.offsets[rows]:self.offsets[rows + 1]]).decode('utf-8')
+        rows = np.arange(len(self))[rows]
+        values = np.empty(len(rows), dtype=object)
+        for i, row in enumerate(rows):
+            values[i] = self[row]
+        return values
+
+
+def make_text_ids(pages):
+    # page + incrementing index for each page, pages must be sorted
+    pages = np.asarray(pages)
+    counters = np.arange(len(pages)) - np.searchsorted(pages, pages) + 1
+    return np.char.add(np.char.add(pages.astype(str), '_'), counters.astype(str))
+
+
+def next_text_ids(pages, page_count):
+    # text ids continuing the counter of every page, page_count(page) is its current number of rows
+    pages = np.asarray(pages)
+    order = np.argsort(pages, kind='stable')
+    sorted_pages = pages[order]
+    counters = np.arange(len(pages)) - np.searchsorted(sorted_pages, sorted_pages) + 1
+    counters += np.array([page_count(page) for page in sorted_pages], dtype=np.int64)
+    text_ids = np.empty(len(pages), dtype=object)
+    text_ids[order] = [f'{page}_{counter}' for page, counter in zip(sorted_pages, counters)]
+    return text_ids.astype(str)
+
+
+def write_texts(texts, offsets_path, blob_path, n_texts=None):
+    offsets = np.zeros((len(texts) if n_texts is None else n_texts) + 1, dtype=np.int64)
+    with open(blob_path, 'wb') as blob:
+        for i, text in enumerate(texts):
+            encoded = str(text).encode('utf-8')
+            blob.write(encoded)
+            offsets[i + 1] = offsets[i] + len(encoded)
+    np.save(offsets_path, offsets)
+
+
+def append_texts(texts, offsets_path, blob_path):
+    # Same layout as write_texts, added at the end of existing files
+    offsets = np.empty(len(texts), dtype=np.int64)
+    end = np.load(offsets_path, mmap_mode='r')[-1]
+    with open(blob_path, 'ab') as blob:
+        for i, text in enumerate(texts):
+            encoded = str(text).encode('utf-8')
+            blob.write(encoded)
+            end += len(encoded)
+            offsets[i] = end
+    append_npy(offsets_path, offsets)
+
+
+def append_npy(path, values):
+    """Add ``values`` along the first axis of the .npy file at ``path`` and return it memory mapped.
+
+    np.save leaves room in the header for the row count to grow, so only the
+    new rows and the header are written. String columns are rewritten when
+    the new values are wider than the stored ones.
+    """
+    current = np.load(path, mmap_mode='r')
+    values = np.asarray(values)
+    if values.dtype.kind == current.dtype.kind == 'U' and values.dtype.itemsize > current.dtype.itemsize:
+        np.save(path + '.tmp.npy', np.concatenate([current, values]))
+        del current
+        os.replace(path + '.tmp.npy', path)
+        return np.load(path, mmap_mode='r')
+
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        header_size = f.tell()
+
+        header = io.BytesIO()
+        write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+        write_header(header, {'shape': (shape[0] + len(values),) + shape[1:], 'fortran_order': fortran_order,
+                              'descr': np.lib.format.dtype_to_descr(dtype)})
+        if header.tell() != header_size or fortran_order:
+            raise ValueError(f'{path} can not be extended in place')
+
+        # rows first, the header only counts them once they are written
+        f.seek(0, os.SEEK_END)
+        f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+        f.flush()
+        f.seek(0)
+        f.write(header.getvalue())
+    return np.load(path, mmap_mode='r')
+
+
+class StoreChangedError(RuntimeError):
+    """The store on disk has rows this process has not loaded, another process appended to it."""
+
+
+class EmbeddingStore:
+    """Columns of the explorer, rows sorted by page.
+
+    ``coordinates`` are the plotted (N, 3) positions, ``vectors`` the unit
+    length float32 vectors used for similarity, ``pages`` and ``text_ids`` one
+    value per row and ``texts`` anything indexable by row. ``knn_indices`` and
+    ``knn_scores`` are the precomputed neighbour graph from knn_graph.py, when
+    it has been built. ``quantized`` is the optional low precision copy of
+    the vectors (see ``quantize``), ``cluster_labels`` and
+    ``cluster_centroids`` the k-means clusters from clusters.py.
+
+    A store saved to a directory is opened with every column memory mapped,
+    so opening costs no parsing and several processes share the same pages.
+    ``path`` is that directory, None for an in memory store.
+    """
+
+    def __init__(self, coordinates, vectors, pages, text_ids, texts, knn_indices=None, knn_scores=None, path=None,
+                 quantized=None, cluster_labels=None, cluster_centroids=None):
+        self.path = path
+        self.coordinates = coordinates
+        self.vectors = vectors
+        self.pages = pages
+        self.text_ids = text_ids
+        self.texts = texts
+        self.knn_indices = knn_indices
+        self.knn_scores = knn_scores
+        self.quantized = quantized
+        self.cluster_labels = cluster_labels
+        self.cluster_centroids = cluster_centroids
+
+    def __len__(self):
+        return len(self.pages)
+
+    @classmethod
+    def from_frame(cls, df, coordinate_columns=('0', '1', '2')):
+        """Build an in memory store from a DataFrame with ``text``, ``page``,
+        the coordinate columns and optionally ``text_id``."""
+        df = df.sort_values('page', kind='stable').reset_index(drop=True)
+        coordinates = df[list(coordinate_columns)].to_numpy(dtype=np.float32)
+        if 'text_id' in df:
+            text_ids = df['text_id'].to_numpy().astype(str)
+        else:
+            text_ids = make_text_ids(df['page'].to_numpy())
+        return cls(
+            coordinates=coordinates,
+            vectors=normalize_rows(coordinates),
+            pages=df['page'].to_numpy(),
+            text_ids=text_ids,
+            texts=df['text'].to_numpy(dtype=object),
+        )
+
+    @classmethod
+    def open(cls, path):
+        knn_indices, knn_scores = None, None
+        if os.path.exists(os.path.join(path, 'knn_indices.npy')):
+            knn_indices = np.load(os.path.join(path, 'knn_indices.npy'), mmap_mode='r')
+            knn_scores = np.load(os.path.join(path, 'knn_scores.npy'), mmap_mode='r')
+        quantized = None
+        for dtype in ('int8', 'float16'):
+            if os.path.exists(os.path.join(path, f'vectors_{dtype}.npy')):
+                scales_path = os.path.join(path, 'vector_scales.npy')
+                quantized = QuantizedVectors(np.load(os.path.join(path, f'vectors_{dtype}.npy'), mmap_mode='r'),
+                                             np.load(scales_path, mmap_mode='r') if dtype == 'int8' else None)
+        cluster_labels, cluster_centroids = None, None
+        if os.path.exists(os.path.join(path, 'cluster_labels.npy')):
+            cluster_labels = np.load(os.path.join(path, 'cluster_labels.npy'), mmap_mode='r')
+            cluster_centroids = np.load(os.path.join(path, 'cluster_centroids.npy'))
+        return cls(
+            coordinates=np.load(os.path.join(path, 'coordinates.npy'), mmap_mode='r'),
+            vectors=np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r'),
+            pages=np.load(os.path.join(path, 'page.npy'), mmap_mode='r'),
+            text_ids=np.load(os.path.join(path, 'text_id.npy'), mmap_mode='r'),
+            texts=TextColumn.open(os.path.join(path, 'text_offsets.npy'), os.path.join(path, 'texts.bin')),
+            knn_indices=knn_indices,
+            knn_scores=knn_scores,
+            path=path,
+            quantized=quantized,
+            cluster_labels=cluster_labels,
+            cluster_centroids=cluster_centroids,
+        )
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'coordinates.npy'), np.asarray(self.coordinates, dtype=np.float32))
+        np.save(os.path.join(path, 'vectors.npy'), np.asarray(self.vectors, dtype=np.float32))
+        np.save(os.path.join(path, 'page.npy'), np.asarray(self.pages))
+        np.save(os.path.join(path, 'text_id.npy'), np.asarray(self.text_ids).astype(str))
+        write_texts(self.texts[np.arange(len(self))] if isinstance(self.texts, TextColumn) else self.texts,
+                    os.path.join(path, 'text_offsets.npy'), os.path.join(path, 'texts.bin'))
+        if self.quantized is not None:
+            self.save_quantized(path)
+
+    def quantize(self, dtype):
+        """Add a ``dtype`` ('float16' or 'int8') copy of the vectors, saved next to them when opened from a directory."""
+        self.quantized = QuantizedVectors.from_vectors(self.vectors, dtype)
+        if self.path is not None:
+            self.save_quantized(self.path)
+            self.quantized = EmbeddingStore.open(self.path).quantized
+
+    def save_quantized(self, path):
+        # written to temporary files first, the codes last since open looks for them,
+        # so a server opening the store meanwhile never reads a half written copy
+        codes_path = os.path.join(path, f'vectors_{self.quantized.dtype}.npy')
+        scales_path = os.path.join(path, 'vector_scales.npy')
+        np.save(codes_path + '.tmp.npy', np.asarray(self.quantized.codes))
+        if self.quantized.scales is not None:
+            np.save(scales_path + '.tmp.npy', np.asarray(self.quantized.scales))
+            os.replace(scales_path + '.tmp.npy', scales_path)
+        os.replace(codes_path + '.tmp.npy', codes_path)
+
+    def append(self, coordinates, vectors, pages, text_ids, texts):
+        """Add rows at the end, in place on disk when the store was opened from a directory.
+
+        ``vectors`` must be unit length. The new rows are not merged into the
+        page order, PageIndex keeps track of them separately. The neighbour
+        graph is left as is and only covers the rows it was built for. New
+        rows join the cluster of their nearest centroid.
+
+        On disk the rows are written under a lock on ``append.lock`` in the
+        directory, StoreChangedError is raised when another process appended
+        since this one opened the store.
+        """
+        labels = None
+        if self.cluster_labels is not None:
+            labels = clusters.assign(np.asarray(vectors, dtype=np.float32), self.cluster_centroids)
+        if self.path is None:
+            self.coordinates = np.concatenate([self.coordinates, np.asarray(coordinates, dtype=np.float32)])
+            self.vectors = np.concatenate([self.vectors, np.asarray(vectors, dtype=np.float32)])
+            self.pages = np.concatenate([self.pages, pages])
+            self.text_ids = np.concatenate([self.text_ids, np.asarray(text_ids).astype(str)])
+            self.texts = np.concatenate([self.texts, np.asarray(texts, dtype=object)])
+            if self.quantized is not None:
+                codes, scales = quantize(vectors, self.quantized.dtype)
+                self.quantized = QuantizedVectors(
+                    np.concatenate([self.quantized.codes, codes]),
+                    None if scales is None else np.concatenate([self.quantized.scales, scales]))
+            if labels is not None:
+                self.cluster_labels = np.concatenate([self.cluster_labels, labels])
+            return
+
+        path = self.path
+        with open(os.path.join(path, 'append.lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            on_disk = len(np.load(os.path.join(path, 'page.npy'), mmap_mode='r'))
+            if on_disk != len(self):
+                raise StoreChangedError(f'{path} has {on_disk} rows, {len(self)} were loaded, reopen the store')
+            append_texts(texts, os.path.join(path, 'text_offsets.npy'), os.path.join(path, 'texts.bin'))
+            self.texts = TextColumn.open(os.path.join(path, 'text_offsets.npy'), os.path.join(path, 'texts.bin'))
+            self.text_ids = append_npy(os.path.join(path, 'text_id.npy'), np.asarray(text_ids).astype(str))
+            self.pages = append_npy(os.path.join(path, 'page.npy'), pages)
+            self.vectors = append_npy(os.path.join(path, 'vectors.npy'), np.asarray(vectors, dtype=np.float32))
+            self.coordinates = append_npy(os.path.join(path, 'coordinates.npy'),
+                                          np.asarray(coordinates, dtype=np.float32))
+            if self.quantized is not None:
+                codes, scales = quantize(vectors, self.quantized.dtype)
+                self.quantized = QuantizedVectors(
+                    append_npy(os.path.join(path, f'vectors_{self.quantized.dtype}.npy'), codes),
+                    None if scales is None else append_npy(os.path.join(path, 'vector_scales.npy'), scales))
+            if labels is not None:
+                self.cluster_labels = append_npy(os.path.join(path, 'cluster_labels.npy'), labels)
+
+
+def ingest(path, embeddings, pages, texts, method='pca', cache_dir=None):
+    """Write a store for high dimensional ``embeddings`` (an array or memory
+    mapped .npy) with one page and text per row.
+
+    The full dimensional vectors are kept for similarity and the plotted
+    coordinates come from a batched projection to 3D, cached under
+    ``cache_dir``. Rows are written in page order one batch at a time.
+    """
+    os.makedirs(path, exist_ok=True)
+    pages = np.asarray(pages)
+    order = np.argsort(pages, kind='stable')
+
+    coordinates = projection.project(embeddings, method, cache_dir)
+    np.save(os.path.join(path, 'coordinates.npy'), np.asarray(coordinates[order], dtype=np.float32))
+
+    vectors = np.lib.format.open_memmap(os.path.join(path, 'vectors.npy'), mode='w+', dtype=np.float32,
+                                        shape=embeddings.shape)
+    for start in range(0, len(order), projection.batch_size):
+        rows = order[start:start + projection.batch_size]
+        # sorted reads are much faster on a memory mapped file
+        read_order = np.argsort(rows)
+        batch = np.empty((len(rows), embeddings.shape[1]), dtype=np.float32)
+        batch[read_order] = embeddings[rows[read_order]]
+        vectors[start:start + len(rows)] = normalize_rows(batch)
+    vectors.flush()
+
+    pages = pages[order]
+    np.save(os.path.join(path, 'page.npy'), pages)
+    np.save(os.path.join(path, 'text_id.npy'), make_text_ids(pages))
+    write_texts((texts[row] for row in order), os.path.join(path, 'text_offsets.npy'),
+                os.path.join(path, 'texts.bin'), len(order))
+
+
+if __name__ == '__main__':
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description='Convert a csv with text, 0, 1, 2 and page columns to a store')
+    parser.add_argument('csv')
+    parser.add_argument('output')
+    parser.add_argument('--embeddings', help='.npy file of high dimensional embeddings, one row per csv row; '
+                                             'the csv then only needs text and page columns')
+    parser.add_argument('--projection', choices=sorted(projection.reducers), default='pca')
+    parser.add_argument('--cache-dir', default='.projection-cache')
+    parser.add_argument('--quantize', choices=['float16', 'int8'],
+                        help='also store a low precision copy of the vectors for faster, smaller scans')
+    parser.add_argument('--clusters', type=int, help='cluster the vectors into this many clusters for the overview')
+    args = parser.parse_args()
+
+    if args.embeddings:
+        metadata = pd.read_csv(args.csv, usecols=['text', 'page'])
+        ingest(args.output, np.load(args.embeddings, mmap_mode='r'), metadata['page'].to_numpy(),
+               metadata['text'].to_numpy(dtype=object), args.projection, args.cache_dir)
+    else:
+        EmbeddingStore.from_frame(pd.read_csv(args.csv)).save(args.output)
+    if args.quantize:
+        EmbeddingStore.open(args.output).quantize(args.quantize)
+    if args.clusters:
+        clusters.build(args.output, args.clusters)
@@ -0,0 +1,50 @@
+"""Compact encodings for figure payloads.
+
+Numeric trace arrays are sent as plotly typed array specs (``{'dtype', 'bdata',
+'shape'}``, base64 of the raw little endian bytes) instead of JSON lists of
+numbers, which plotly.js 2.28+ decodes straight into typed arrays. Plotly.py 6+
+accepts them in graph objects. customdata is sent as a list, see
+``with_customdata``.
+"""
+import base64
+
+import numpy as np
+
+int_dtypes = [np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32]
+
+
+def typed_array(values, dtype=None):
+    """Typed array spec of ``values`` (1 or 2 dimensional) cast to ``dtype``."""
+    values = np.ascontiguousarray(values, dtype=dtype)
+    values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+    spec = {'dtype': values.dtype.str[1:], 'bdata': base64.b64encode(values.tobytes()).decode('ascii')}
+    if values.ndim > 1:
+        spec['shape'] = ', '.join(str(n) for n in values.shape)
+    return spec
+
+
+def smallest_int_dtype(values):
+    """Smallest integer dtype holding every value, e.g. int8 for page numbers below 128."""
+    values = np.asarray(values)
+    if len(values) == 0:
+        return np.int8
+    lo, hi = values.min(), values.max()
+    for dtype in int_dtypes:
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    # plotly has no 64 bit integer arrays
+    return np.float64
+
+
+def with_customdata(trace, customdata):
+    """``trace`` (a graph object) as a dict with ``customdata`` as a JSON list.
+
+    dcc.Graph copies customdata into click and hover events without decoding
+    typed arrays, so it is sent as a list. Plotly validates every item of a
+    list given to a graph object, which takes seconds for 500k points, so the
+    list is set on the dict instead.
+    """
+    trace = trace.to_plotly_json()
+    trace['customdata'] = customdata if isinstance(customdata, list) else np.asarray(customdata).tolist()
+    return trace
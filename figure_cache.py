@@ -0,0 +1,214 @@
+"""Server side cache and compression of Dash update responses.
+
+Base figures are the same for every session showing a page, so their
+serialised responses are cached, gzip compressed, under a key derived from the
+request (see ``init_figure_cache``) and sent back without running the callback,
+building the figure or serialising it again.
+"""
+import gzip
+import json
+import logging
+import os
+import threading
+from collections import Counter, OrderedDict
+
+import flask
+
+# compression level of responses, base64 typed arrays gain little from higher levels
+gzip_level = 1
+
+# header marking the requests sent by warm
+warm_header = 'X-Figure-Cache-Warm'
+
+
+class FigureCache:
+    """Thread safe LRU of compressed responses, bounded by their total size."""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, compressed):
+        if len(compressed) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = compressed
+            self.size += len(compressed)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.size,
+                    'max_bytes': self.max_bytes}
+
+
+class PageViews:
+    """View counts per page, saved to ``path`` so the next start can pre-warm the most viewed."""
+
+    def __init__(self, path=None, save_every=50):
+        self.path = path
+        self.save_every = save_every
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.counts.update({json.dumps(json.loads(page)): count for page, count in json.load(f).items()})
+
+    def add(self, page):
+        with self.lock:
+            self.counts[json.dumps(page)] += 1
+            total = sum(self.counts.values())
+        # saved in a thread so a slow or failing write never delays the request
+        if self.path and total % self.save_every == 0:
+            threading.Thread(target=self.save, name='save-page-views', daemon=True).start()
+
+    def most_viewed(self, n):
+        with self.lock:
+            return [json.loads(page) for page, _ in self.counts.most_common(n)]
+
+    def save(self):
+        # every worker of a server writes its own temporary file, the last replace wins
+        with self.lock:
+            counts = dict(self.counts)
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        with self.save_lock:
+            try:
+                with open(temporary, 'w') as f:
+                    json.dump(counts, f)
+                os.replace(temporary, self.path)
+            except OSError as error:
+                logging.getLogger(__name__).warning('page views not saved to %s: %s', self.path, error)
+
+
+def build_request_body(app, output, values, changed):
+    """Body of a _dash-update-component request for the callback writing ``output``.
+
+    ``output`` is one 'id.property' of the callback, ``values`` maps
+    'id.property' to the value the browser would send (missing ones are None).
+    """
+    key = next(key for key in app.callback_map if output in key.strip('.').split('...'))
+    callback = app.callback_map[key]
+
+    def props(dependencies):
+        return [{'id': d['id'], 'property': d['property'], 'value': values.get(f"{d['id']}.{d['property']}")}
+                for d in dependencies]
+
+    if key.startswith('..'):
+        outputs = [{'id': o.rsplit('.', 1)[0], 'property': o.rsplit('.', 1)[1]} for o in key.strip('.').split('...')]
+    else:
+        outputs = {'id': key.rsplit('.', 1)[0], 'property': key.rsplit('.', 1)[1]}
+    return {
+        'output': key,
+        'outputs': outputs,
+        'inputs': props(callback['inputs']),
+        'state': props(callback['state']),
+        'changedPropIds': changed,
+    }
+
+
+def request_values(body):
+    """Map 'id.property' to value for the inputs and state of a request body."""
+    return {f"{d['id']}.{d['property']}": d.get('value') for d in body.get('inputs', []) + body.get('state', [])}
+
+
+def init_figure_cache(server, cache, key_fn):
+    """Answer cacheable update requests on ``server`` from ``cache``.
+
+    ``key_fn(body)`` returns the cache key of a request body, or None when the
+    response depends on per session state and must not be cached. Call it
+    after ``init_compression`` so its hook sees the uncompressed responses.
+    """
+
+    @server.before_request
+    def serve_cached_figure():
+        if not flask.request.path.endswith('_dash-update-component'):
+            return None
+        body = flask.request.get_json(silent=True)
+        key = key_fn(body) if body else None
+        if key is None:
+            return None
+
+        flask.g.figure_cache_key = key
+        compressed = cache.get(key)
+        if compressed is None:
+            return None
+
+        flask.g.metrics_callback = 'figure_cache'
+
+        if 'gzip' in flask.request.headers.get('Accept-Encoding', ''):
+            response = flask.Response(compressed, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+        return flask.Response(gzip.decompress(compressed), mimetype='application/json')
+
+    @server.after_request
+    def store_figure(response):
+        key = flask.g.get('figure_cache_key')
+        if key is None or response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return response
+
+        compressed = gzip.compress(response.get_data(), gzip_level)
+        cache.put(key, compressed)
+        # the response is compressed once, for the cache and the client
+        if 'gzip' in flask.request.headers.get('Accept-Encoding', ''):
+            response.set_data(compressed)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+
+def init_compression(server, min_bytes=1024):
+    """Gzip update responses of ``server`` when the client accepts it.
+
+    Used when flask-compress (``pip install dash[compress]``) is not installed.
+    """
+
+    @server.after_request
+    def compress_response(response):
+        if (not flask.request.path.endswith('_dash-update-component') or response.status_code != 200
+                or 'Content-Encoding' in response.headers or response.direct_passthrough
+                or 'gzip' not in flask.request.headers.get('Accept-Encoding', '')):
+            return response
+        data = response.get_data()
+        if len(data) < min_bytes:
+            return response
+        response.set_data(gzip.compress(data, gzip_level))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+
+def warm(app, bodies):
+    """Send the given request bodies once so their responses are cached."""
+    client = app.server.test_client()
+    for body in bodies:
+        client.post('/_dash-update-component', json=body, headers={'Accept-Encoding': 'gzip', warm_header: '1'})
+
+
+def is_warm_request():
+    """Whether the current request was sent by ``warm``."""
+    return flask.request.headers.get(warm_header) == '1'
@@ -0,0 +1,104 @@
+"""Precompute the top-K cosine neighbours of every row of an embedding store.
+
+    python knn_graph.py STORE_DIR --k 100
+
+The result is written next to the store as ``knn_indices.npy`` (int32) and
+``knn_scores.npy`` (float16), best neighbour first, and is picked up by
+``EmbeddingStore.open``.
+"""
+import argparse
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+# rows per task, every task holds a (block_size, column_block_size) score matrix
+block_size = 2048
+column_block_size = 65536
+
+_vectors = None
+
+
+def _open_vectors(path):
+    global _vectors
+    _vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+
+
+def block_neighbours(vectors, start, stop, k):
+    """Top ``k`` neighbours of rows ``start:stop`` against every row, self excluded."""
+    queries = np.asarray(vectors[start:stop], dtype=np.float32)
+    n_queries = len(queries)
+    best_indices = np.empty((n_queries, 0), dtype=np.int64)
+    best_scores = np.empty((n_queries, 0), dtype=np.float32)
+    query_rows = np.arange(start, stop)
+
+    for column_start in range(0, len(vectors), column_block_size):
+        columns = np.asarray(vectors[column_start:column_start + column_block_size], dtype=np.float32)
+        scores = queries @ columns.T
+
+        # the query rows themselves are not neighbours
+        own = (query_rows >= column_start) & (query_rows < column_start + len(columns))
+        scores[own.nonzero()[0], query_rows[own] - column_start] = -np.inf
+
+        # keep the best k of this block, then merge with the best so far
+        if scores.shape[1] > k:
+            candidates = np.argpartition(scores, -k, axis=1)[:, -k:]
+        else:
+            candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+
+        merged_indices = np.concatenate([best_indices, candidates + column_start], axis=1)
+        merged_scores = np.concatenate([best_scores, candidate_scores], axis=1)
+        if merged_scores.shape[1] > k:
+            keep = np.argpartition(merged_scores, -k, axis=1)[:, -k:]
+            merged_indices = np.take_along_axis(merged_indices, keep, axis=1)
+            merged_scores = np.take_along_axis(merged_scores, keep, axis=1)
+        best_indices, best_scores = merged_indices, merged_scores
+
+    order = np.argsort(-best_scores, axis=1)
+    return (np.take_along_axis(best_indices, order, axis=1).astype(np.int32),
+            np.take_along_axis(best_scores, order, axis=1).astype(np.float16))
+
+
+def _block_task(args):
+    start, stop, k = args
+    indices, scores = block_neighbours(_vectors, start, stop, k)
+    return start, indices, scores
+
+
+def build(path, k=100, processes=None):
+    """Compute the graph for the store in ``path`` with a pool of ``processes``.
+
+    Every worker maps the vectors itself, and finished blocks are written
+    straight to memory mapped outputs, so memory stays bounded by the block
+    sizes whatever the corpus size.
+    """
+    n_rows = len(np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r'))
+    k = max(0, min(k, n_rows - 1))
+
+    indices = np.lib.format.open_memmap(os.path.join(path, 'knn_indices.npy.tmp'), mode='w+', dtype=np.int32,
+                                        shape=(n_rows, k))
+    scores = np.lib.format.open_memmap(os.path.join(path, 'knn_scores.npy.tmp'), mode='w+', dtype=np.float16,
+                                       shape=(n_rows, k))
+
+    tasks = [(start, min(start + block_size, n_rows), k) for start in range(0, n_rows, block_size)]
+    with Pool(processes, initializer=_open_vectors, initargs=(path,)) as pool:
+        for start, block_indices, block_scores in pool.imap_unordered(_block_task, tasks):
+            indices[start:start + len(block_indices)] = block_indices
+            scores[start:start + len(block_scores)] = block_scores
+
+    indices.flush()
+    scores.flush()
+    del indices, scores
+    os.replace(os.path.join(path, 'knn_indices.npy.tmp'), os.path.join(path, 'knn_indices.npy'))
+    os.replace(os.path.join(path, 'knn_scores.npy.tmp'), os.path.join(path, 'knn_scores.npy'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('store')
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    build(args.store, args.k, args.processes)
@@ -0,0 +1,99 @@
+import numpy as np
+
+
+# voxels per axis used to spread the sample over the whole scene
+grid_cells = 64
+
+# zoom levels are powers of two of the default camera zoom, capped at this level
+max_level = 6
+
+# radius of the full detail region at zoom level 1, in normalised scene units
+focus_radius = 0.5
+
+# distance of plotly's default camera eye (1.25, 1.25, 1.25) from the scene center
+default_eye_distance = np.sqrt(3 * 1.25 ** 2)
+
+
+def camera_view(camera):
+    """Return ``(level, center)`` for a ``scene.camera`` relayout value.
+
+    ``level`` is 0 at the default zoom and grows by one every time the eye
+    distance halves, ``center`` is the camera center in normalised scene units.
+    """
+    if not camera or 'eye' not in camera:
+        return 0, np.zeros(3)
+
+    eye = np.array([camera['eye'].get(axis, 0) for axis in 'xyz'], dtype=float)
+    center = np.array([(camera.get('center') or {}).get(axis, 0) for axis in 'xyz'], dtype=float)
+    distance = np.linalg.norm(eye - center)
+    if distance == 0:
+        return max_level, center
+
+    level = int(np.clip(np.floor(np.log2(default_eye_distance / distance)), 0, max_level))
+    return level, center
+
+
+def view_key(camera):
+    """Key that only changes when the sample for ``camera`` would change.
+
+    A list so it compares equal to itself after a round trip through a dcc.Store.
+    """
+    level, center = camera_view(camera)
+    if level == 0:
+        return 0
+    step = focus_radius / 2 ** level / 2
+    return [level] + [int(v) for v in np.round(center / step)]
+
+
+def density_sample(rows, points, budget, seed=0):
+    """Pick at most about ``budget`` of ``rows`` while keeping the point density.
+
+    Points are bucketed in a voxel grid and every occupied voxel keeps a share
+    of its points proportional to its population (at least one), so sparse
+    regions stay visible and dense regions stay dense. The sample is
+    deterministic for a given input.
+    """
+    if len(rows) <= budget:
+        return rows
+
+    lo = points.min(axis=0)
+    span = points.max(axis=0) - lo
+    span[span == 0] = 1
+    voxels = np.minimum(((points - lo) / span * grid_cells).astype(np.int64), grid_cells - 1)
+    keys = (voxels[:, 0] * grid_cells + voxels[:, 1]) * grid_cells + voxels[:, 2]
+
+    # random order within each voxel, voxels contiguous
+    order = np.random.default_rng(seed).permutation(len(rows))
+    order = order[np.argsort(keys[order], kind='stable')]
+    sorted_keys = keys[order]
+
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    counts = np.diff(np.r_[starts, len(order)])
+    ranks = np.arange(len(order)) - np.repeat(starts, counts)
+    quotas = np.maximum(1, np.floor(counts * budget / len(rows))).astype(np.int64)
+
+    return np.sort(rows[order[ranks < np.repeat(quotas, counts)]])
+
+
+def sample_rows(rows, coordinates, camera, max_points, keep=()):
+    """Rows to draw for the current camera.
+
+    At the overview level this is a density preserving sample of ``rows``. When
+    zoomed in, the region around the camera center is added at a density that
+    doubles with every zoom level. ``keep`` rows are always included.
+    """
+    points = coordinates[rows]
+    sample = density_sample(rows, points, max_points)
+
+    level, center = camera_view(camera)
+    if level > 0 and len(sample) < len(rows):
+        lo = points.min(axis=0)
+        span = points.max(axis=0) - lo
+        span[span == 0] = 1
+        normalised = (points - lo) / span - 0.5
+        focus = np.linalg.norm(normalised - center, axis=1) <= focus_radius / 2 ** level
+        sample = np.union1d(sample, density_sample(rows[focus], points[focus], max_points))
+
+    if len(keep):
+        sample = np.union1d(sample, keep)
+    return sample
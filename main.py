@@ -1,43 +1,456 @@
+import importlib.util
+import json
+import logging
+import os
+import threading
+
 import dash
+import flask
 import numpy as np
-import pandas as pd
-from dash import dcc
+from dash import DiskcacheManager, Patch, ctx, dcc, no_update
 from dash import html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ALL, Input, Output, State
 from plotly import graph_objects as go
-from sklearn.metrics.pairwise import cosine_similarity
+
+import lod
+from encoding import smallest_int_dtype, typed_array, with_customdata
+from embedding_store import EmbeddingStore, StoreChangedError, next_text_ids
+from figure_cache import FigureCache, PageViews, build_request_body, init_compression, init_figure_cache, \
+    is_warm_request, request_values, warm
+from metrics import init_metrics, instrument, metrics
+from page_index import PageIndex, row_array, row_count
+from similarity import NeighbourCache, SimilarityEngine, in_scope, normalize_rows
+from text_index import load_or_build
 
 # parameters
 default_similarity_threshold = 20
+# score cutoff mode: default cosine similarity cutoff and hard cap on the number of results
+default_score_cutoff = 0.85
+score_cutoff_max_results = 1000
+# the side panel lists at most this many results, the overlay draws all of them
+panel_max_results = 100
+# search matches highlighted in the plot and listed (as similarity seeds) in the sidebar
+search_max_points = 100000
+search_panel_results = 10
 point_size = 3
-
-# Creating the sample DataFrame
-data = [
-    ["This is the first sample text.", 3.2, 4.5, 6.7, 1],
-    ["Here's another sample text.", 7.1, 2.3, 8.9, 2],
-    ["A third sample text.", 9.4, 1.8, 5.2, 3],
-    ["One more sample text.", 6.6, 3.9, 2.1, 1],
-    ["Last sample text.", 4.8, 7.2, 9.5, 2]
-]
-
-df = pd.DataFrame(data, columns=['text', '0', '1', '2', 'page'])
-
-# Update the DataFrame to include the "text_id" column page + incrementing index for each page
-df['text_id'] = df['page'].astype(str) + '_' + df.groupby('page').cumcount().add(1).astype(str)
-
-# Compute cosine similarity matrix
-similarity_matrix = cosine_similarity(df[['0', '1', '2']])
+# use the approximate similarity index from this many rows on
+approximate_index_min_rows = 200000
+# first pass of similarity scans on a float16 or int8 copy of the vectors, re-ranked exactly.
+# Stores get theirs offline with embedding_store.py --quantize and always use it, this
+# only quantises the in memory sample data
+vector_quantization = os.environ.get('EXPLORER_QUANTIZATION')
+# number of neighbour results kept for reuse between callbacks
+neighbour_cache_size = 1024
+# pages with more points than this are decimated according to the camera zoom
+lod_max_points = 200000
+# pages with more points than this show one marker per cluster at overview zoom, when the
+# store has been clustered (clusters.py), clicking a cluster marker expands it into its points
+cluster_overview_min_points = 50000
+cluster_max_marker_size = 20
+# from this many rows on, clicks are answered by background jobs with a progress bar
+background_min_rows = int(os.environ.get('EXPLORER_BACKGROUND_MIN_ROWS', 1000000))
+# total size of the compressed base figures kept in memory
+figure_cache_bytes = int(os.environ.get('EXPLORER_FIGURE_CACHE_BYTES', 256 * 1024 * 1024))
+# page view counts are saved to this file, the most viewed pages are cached at startup
+page_views_path = os.environ.get('EXPLORER_PAGE_VIEWS')
+prewarm_pages = int(os.environ.get('EXPLORER_PREWARM_PAGES', 10))
+# open sessions check for appended rows this often
+dataset_poll_seconds = 10
+# batch neighbour requests (POST /neighbours) running at once, further ones are refused
+batch_max_concurrent = int(os.environ.get('EXPLORER_BATCH_CONCURRENCY', 2))
+# queries of a batch request scored together, and the largest k it may ask for
+batch_block_size = 256
+batch_max_k = 1000
+
+# When the similarity and text indexes are opened (or built, the first time): 'background'
+# in a thread started by the first request of the process so workers start serving at
+# once, 'lazy' on first use, 'eager' before serving, e.g. with gunicorn --preload so
+# forked workers share them
+startup_mode = os.environ.get('EXPLORER_STARTUP', 'background')
+
+# Directory of a store written by embedding_store.py, the sample data is used when unset
+data_path = os.environ.get('EXPLORER_DATA')
+
+if data_path:
+    # every column is memory mapped, texts are only read when shown
+    store = EmbeddingStore.open(data_path)
+else:
+    # Creating the sample DataFrame, pandas is only needed for it
+    import pandas as pd
+
+    data = [
+        ["This is the first sample text.", 3.2, 4.5, 6.7, 1],
+        ["Here's another sample text.", 7.1, 2.3, 8.9, 2],
+        ["A third sample text.", 9.4, 1.8, 5.2, 3],
+        ["One more sample text.", 6.6, 3.9, 2.1, 1],
+        ["Last sample text.", 4.8, 7.2, 9.5, 2]
+    ]
+
+    df = pd.DataFrame(data, columns=['text', '0', '1', '2', 'page'])
+
+    # The store adds the "text_id" column page + incrementing index for each page
+    # and sorts the rows by page so every page is a contiguous block of rows
+    store = EmbeddingStore.from_frame(df)
+
+# Columns as arrays for vectorised lookups
+coordinates = store.coordinates
+pages = store.pages
+texts = store.texts
+text_ids = store.text_ids
+n_rows = len(store)
+page_index = PageIndex(pages)
+
+# Build the similarity engine once, queries then only need a partial selection
+# or, when knn_graph.py has been run on the store, a lookup. The approximate index
+# is saved next to the store the first time it is trained
+n_lists = int(np.sqrt(n_rows)) if n_rows >= approximate_index_min_rows else 0
+graph = (store.knn_indices, store.knn_scores) if store.knn_indices is not None else None
+if vector_quantization and store.quantized is None:
+    # quantising a store here would make every worker write the same files at startup
+    if data_path:
+        logging.getLogger(__name__).warning('%s has no quantised vectors, write them offline with '
+                                            'EmbeddingStore.open(path).quantize(%r)', data_path, vector_quantization)
+    else:
+        store.quantize(vector_quantization)
+similarity_engine = SimilarityEngine(store.vectors, n_lists=n_lists, normalized=True, graph=graph,
+                                     quantized=store.quantized, index_path=data_path, lazy=True)
+
+# Clicks and page changes reuse the same neighbour results
+neighbour_cache = NeighbourCache(neighbour_cache_size)
+
+# Base figures only change with the data, cached responses are keyed by this version.
+# Rows are only ever appended, so the version is the number of rows: it means the same
+# in every worker of a multi-process server and after a restart. Only the worker whose
+# rows match the files can append (see EmbeddingStore.append), the others keep serving
+# the rows they loaded and refuse appends until they are restarted
+dataset_version = n_rows
+append_lock = threading.Lock()
+
+# Token index of the texts, saved next to the store the first time it is built
+text_index = None
+
+
+def get_text_index():
+    # Opens or builds the text index on first use, appends wait for it
+    global text_index
+    with append_lock:
+        if text_index is None:
+            text_index = load_or_build(data_path, texts)
+        return text_index
+
+
+figure_cache = FigureCache(figure_cache_bytes)
+page_views = PageViews(page_views_path)
+
+# Background jobs run in their own process, a new click terminates the running job
+# and request threads stay free for hover events. Needs `pip install dash[diskcache]`
+background_callback_manager = None
+if n_rows >= background_min_rows:
+    try:
+        import diskcache
+    except ImportError:
+        logging.getLogger(__name__).warning('diskcache is not installed, clicks are answered in the request thread')
+    else:
+        background_callback_manager = DiskcacheManager(diskcache.Cache(os.environ.get('EXPLORER_JOB_CACHE', '.job-cache')))
 
 # dataframe max rows / 2
-n = int(df.shape[0] / 2)
+n = int(n_rows / 2)
 
 # if n > 20 then n = 20
 if n > default_similarity_threshold:
     n = default_similarity_threshold
 
 
-# Creating the Dash application
-app = dash.Dash(__name__)
+def get_page_rows(page_number):
+    # Rows of the given page as a slice, None means all rows
+    if page_number:
+        return page_index.select(page_number)
+    return None
+
+
+def merge_page_ranges(ranges):
+    # Sorted tuple of the (first, last) page ranges covering the given ones, without overlaps
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return tuple(merged)
+
+
+def parse_pages(text):
+    # Pages of a list like "1, 3, 5-8" as (first, last) ranges, see merge_page_ranges.
+    # Ranges are kept as they are so a wide one costs no more than a single page,
+    # parts that aren't numbers are skipped
+    ranges = []
+    for part in (text or '').split(','):
+        first, _, last = part.strip().partition('-')
+        if first.strip().isdigit() and (not last or last.strip().isdigit()) and int(first) <= int(last or first):
+            ranges.append((int(first), int(last or first)))
+    return merge_page_ranges(ranges)
+
+
+def get_scope(scope_mode, page_number, scope_pages):
+    # The rows a similarity search looks at, as a hashable key: ('page', p), ('pages', ((first, last), ...))
+    # or None for the whole corpus. Without a page or a valid page list the whole corpus is searched
+    if scope_mode == 'pages' and parse_pages(scope_pages):
+        return 'pages', parse_pages(scope_pages)
+    if scope_mode != 'all' and page_number:
+        return 'page', page_number
+    return None
+
+
+def get_scope_rows(scope):
+    # A page or a single page range gives a slice, several ranges a sorted array of row
+    # positions, None means all rows
+    if scope is None:
+        return None
+    if scope[0] == 'pages':
+        if len(scope[1]) == 1:
+            return page_index.select(scope[1][0])
+        return np.sort(np.concatenate([row_array(page_index.select(pages), n_rows) for pages in scope[1]]))
+    return page_index.select(scope[1])
+
+
+# text ids in sorted order with their rows, built by the first batch request by id
+text_id_index = None
+
+
+def get_rows_of_text_ids(query_ids):
+    # Row position of every text id, -1 for unknown ones
+    global text_id_index
+    if text_id_index is None:
+        order = np.argsort(text_ids)
+        text_id_index = order, np.asarray(text_ids)[order]
+    order, sorted_ids = text_id_index
+    query_ids = np.asarray(query_ids, dtype=str)
+    positions = np.minimum(np.searchsorted(sorted_ids, query_ids), max(len(sorted_ids) - 1, 0))
+    found = (sorted_ids[positions] == query_ids) if len(sorted_ids) else np.zeros(len(query_ids), dtype=bool)
+    return np.where(found, order[positions], -1)
+
+
+def get_record(row):
+    # Returns (text_id, text, page) of a row position
+    return text_ids[row], texts[row], pages[row]
+
+
+def get_clicked_row(click_data):
+    # Every plotted point carries its row position as customdata, None for cluster markers
+    # (negative customdata) and for points sent without customdata
+    customdata = click_data['points'][0].get('customdata')
+    if customdata is None or customdata < 0:
+        return None
+    return int(customdata)
+
+
+def get_clicked_cluster(click_data):
+    # Cluster markers carry -1 - cluster as customdata, None when the click was on a point
+    point = click_data['points'][0] if click_data else None
+    if point is None or point.get('curveNumber') != cluster_trace or point.get('customdata') is None:
+        return None
+    return -1 - int(point['customdata'])
+
+
+def get_query(similarity_mode, similarity_threshold, score_cutoff):
+    # ('top', n) for the n most similar points or ('cutoff', score) for every point scoring
+    # at least score, None when nothing should be searched
+    if similarity_mode == 'cutoff':
+        return None if score_cutoff is None else ('cutoff', float(score_cutoff))
+    if not similarity_threshold or similarity_threshold <= 0:
+        return None
+    return 'top', similarity_threshold
+
+
+def get_neighbours(clicked_row, scope, query, progress=None):
+    # Returns (similar_rows, similarity_scores) with global row positions, searched within the scope
+    def compute():
+        rows = get_scope_rows(scope)
+        with metrics.timer('similarity.seconds'):
+            if query[0] == 'cutoff':
+                return similarity_engine.range_query(clicked_row, query[1], score_cutoff_max_results, rows=rows,
+                                                     progress=progress)
+            return similarity_engine.top_k(clicked_row, query[1], rows=rows, progress=progress)
+
+    return neighbour_cache.get_or_compute((clicked_row, scope, query), compute)
+
+
+def get_seed_neighbours(seeds, combine, scope, query):
+    # get_neighbours for a set of seed rows, closest to their centroid or to any of them
+    def compute():
+        rows = get_scope_rows(scope)
+        with metrics.timer('similarity.seconds'):
+            if query[0] == 'cutoff':
+                indices, scores = similarity_engine.multi_top_k(seeds, score_cutoff_max_results, combine, rows)
+                keep = scores >= query[1]
+                return indices[keep], scores[keep]
+            return similarity_engine.multi_top_k(seeds, query[1], combine, rows)
+
+    return neighbour_cache.get_or_compute((tuple(seeds), combine, scope, query), compute)
+
+
+def parse_text_ids(text):
+    # Text ids of a comma or space separated list
+    return (text or '').replace(',', ' ').split()
+
+
+# Coordinates and colours are sent as base64 typed arrays of the smallest dtype
+page_dtype = smallest_int_dtype(pages)
+
+# Creating the Dash application, responses are gzipped by flask-compress when installed
+compress = importlib.util.find_spec('flask_compress') is not None
+app = dash.Dash(__name__, compress=compress)
+
+# Callback timings and payload sizes, served on /metrics
+init_metrics(app.server)
+
+if not compress:
+    init_compression(app.server)
+
+
+@app.server.route('/neighbour-cache')
+def neighbour_cache_stats():
+    # Only answers requests from the local host, like /metrics
+    if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+        flask.abort(403)
+    return neighbour_cache.stats()
+
+
+@app.server.route('/figure-cache')
+def figure_cache_stats():
+    # Only answers requests from the local host, like /metrics
+    if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+        flask.abort(403)
+    return figure_cache.stats()
+
+
+def append_rows(new_coordinates, new_vectors, new_pages, new_texts):
+    # Adds rows to the store and extends every index in place, then bumps the dataset
+    # version. Open sessions add the new points of their page on the next poll
+    global coordinates, pages, texts, text_ids, n_rows, page_dtype, dataset_version, text_id_index
+    with append_lock:
+        new_pages = np.asarray(new_pages, dtype=np.asarray(pages).dtype)
+        store.append(new_coordinates, normalize_rows(new_vectors), new_pages,
+                     next_text_ids(new_pages, page_index.page_count), new_texts)
+        similarity_engine.extend(store.vectors, store.quantized)
+        # an index not loaded yet is built from every text
+        if text_index is not None:
+            text_index.append(store.texts, len(store))
+
+        coordinates, pages, texts, text_ids = store.coordinates, store.pages, store.texts, store.text_ids
+        page_dtype = np.promote_types(page_dtype, smallest_int_dtype(new_pages))
+        page_index.append(new_pages)
+        n_rows = len(store)
+
+        neighbour_cache.clear()
+        figure_cache.clear()
+        text_id_index = None
+        dataset_version = n_rows
+
+
+@app.server.route('/append', methods=['POST'])
+def append_endpoint():
+    # POST {"vectors": [[...], ...], "pages": [...], "texts": [...], "coordinates": [[x, y, z], ...]}
+    # with one entry per new row, coordinates can be left out when the vectors are 3D.
+    # Only answers requests from the local host
+    if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+        flask.abort(403)
+    batch = flask.request.get_json(silent=True) or {}
+    try:
+        new_vectors = np.asarray(batch['vectors'], dtype=np.float32)
+        new_pages = np.asarray(batch['pages'], dtype=np.int64)
+        new_texts = [str(text) for text in batch['texts']]
+        new_coordinates = np.asarray(batch.get('coordinates', new_vectors), dtype=np.float32)
+    except (KeyError, TypeError, ValueError) as error:
+        flask.abort(400, f'invalid batch: {error}')
+    if new_vectors.ndim != 2 or new_vectors.shape[1] != store.vectors.shape[1]:
+        flask.abort(400, f'vectors must have {store.vectors.shape[1]} columns')
+    if new_coordinates.shape != (len(new_vectors), 3):
+        flask.abort(400, 'coordinates must have 3 columns')
+    if not len(new_vectors) == len(new_pages) == len(new_texts):
+        flask.abort(400, 'vectors, pages and texts must have one entry per row')
+
+    with metrics.timer('append.seconds'):
+        try:
+            append_rows(new_coordinates, new_vectors, new_pages, new_texts)
+        except StoreChangedError as error:
+            flask.abort(409, str(error))
+    return {'version': dataset_version, 'n_rows': n_rows}
+
+
+batch_slots = threading.BoundedSemaphore(batch_max_concurrent)
+
+
+def batch_neighbour_lines(queries, query_rows, query_ids, k, rows):
+    # One JSON line per query, computed batch_block_size queries at a time. Queries by
+    # text id are answered from the neighbour graph when it can, the rest by batch_top_k
+    for start in range(0, len(query_ids), batch_block_size):
+        block_rows = query_rows[start:start + batch_block_size]
+        results = [None] * len(block_rows)
+        for i, row in enumerate(block_rows):
+            if row >= 0:
+                results[i] = similarity_engine.graph_top_k(int(row), k, rows)
+
+        scan = [i for i, result in enumerate(results) if result is None and (queries is not None or block_rows[i] >= 0)]
+        if scan:
+            if queries is not None:
+                block_queries = queries[start:start + batch_block_size][scan]
+            else:
+                block_queries = np.asarray(similarity_engine.vectors[block_rows[scan]], dtype=np.float32)
+            with metrics.timer('batch_neighbours.block_seconds'):
+                indices, scores = similarity_engine.batch_top_k(block_queries, k, rows, exclude=block_rows[scan])
+            for i, row_indices, row_scores in zip(scan, indices, scores):
+                keep = row_scores > -np.inf
+                results[i] = row_indices[keep], row_scores[keep]
+
+        for i, result in enumerate(results):
+            line = {'query': query_ids[start + i]}
+            if result is None:
+                line['error'] = 'unknown text_id'
+            else:
+                line['text_ids'] = text_ids[result[0]].tolist()
+                line['scores'] = [round(float(score), 6) for score in result[1]]
+            yield json.dumps(line) + '\n'
+
+
+@app.server.route('/neighbours', methods=['POST'])
+def batch_neighbours_endpoint():
+    # POST {"text_ids": [...]} or {"vectors": [[...], ...]} with an optional "k" and "pages"
+    # (the scope, all pages when left out). Streams one JSON line per query, in order:
+    # {"query": text id or vector index, "text_ids": [...], "scores": [...]}.
+    # Only answers requests from the local host, at most batch_max_concurrent at a time
+    if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+        flask.abort(403)
+    batch = flask.request.get_json(silent=True) or {}
+    try:
+        k = int(batch.get('k', default_similarity_threshold))
+        scope = None
+        if batch.get('pages'):
+            scope = 'pages', merge_page_ranges((int(page), int(page)) for page in batch['pages'])
+        if 'text_ids' in batch:
+            queries = None
+            query_ids = [str(text_id) for text_id in batch['text_ids']]
+            query_rows = get_rows_of_text_ids(query_ids)
+        else:
+            queries = normalize_rows(np.asarray(batch['vectors'], dtype=np.float32))
+            query_ids = list(range(len(queries)))
+            query_rows = np.full(len(queries), -1)
+    except (KeyError, TypeError, ValueError) as error:
+        flask.abort(400, f'invalid batch: {error}')
+    if not 1 <= k <= batch_max_k:
+        flask.abort(400, f'k must be between 1 and {batch_max_k}')
+    if queries is not None and queries.shape[1] != store.vectors.shape[1]:
+        flask.abort(400, f'vectors must have {store.vectors.shape[1]} columns')
+
+    # batch jobs never take more than batch_max_concurrent request threads
+    if not batch_slots.acquire(blocking=False):
+        return flask.Response('too many batch requests running, retry later\n', status=429,
+                              headers={'Retry-After': '1'}, mimetype='text/plain')
+    metrics.observe('batch_neighbours.queries', len(query_ids))
+    response = flask.Response(batch_neighbour_lines(queries, query_rows, query_ids, k, get_scope_rows(scope)),
+                              mimetype='application/x-ndjson')
+    response.call_on_close(batch_slots.release)
+    return response
 
 
 # Defining the layout
@@ -64,7 +477,7 @@ app.layout = html.Div([
                     type='number',
                     placeholder='Enter page number',
                     min=1,
-                    max=df['page'].max(),
+                    max=page_index.pages.max() if n_rows else None,
                     step=1
                 ),
                 html.Br(),
@@ -78,12 +491,85 @@ app.layout = html.Div([
                     value=n
                 ),
                 html.Br(),
+                html.H4("Similarity Mode"),
+                dcc.RadioItems(
+                    id='similarity-mode',
+                    options=[
+                        {'label': 'Most similar (threshold)', 'value': 'top'},
+                        {'label': 'Score at least (cutoff)', 'value': 'cutoff'}
+                    ],
+                    value='top',
+                    labelStyle={'display': 'block'}
+                ),
+                html.H4("Score Cutoff"),
+                dcc.Input(
+                    id='similarity-cutoff',
+                    type='number',
+                    placeholder='Enter score cutoff',
+                    min=-1,
+                    max=1,
+                    step=0.01,
+                    value=default_score_cutoff
+                ),
+                html.H4("Search Within"),
+                dcc.RadioItems(
+                    id='similarity-scope',
+                    options=[
+                        {'label': 'Shown page', 'value': 'page'},
+                        {'label': 'Pages', 'value': 'pages'},
+                        {'label': 'All pages', 'value': 'all'}
+                    ],
+                    value='page',
+                    labelStyle={'display': 'block'}
+                ),
+                dcc.Input(
+                    id='scope-pages',
+                    type='text',
+                    placeholder='e.g. 1, 3, 5-8',
+                    debounce=True
+                ),
+                html.Br(),
+                html.Br(),
+                html.Br(),
                 html.Br(),
                 html.Br(),
                 html.Br(),
+                html.Button('Toggle Selection', id='clear-selection-button'),
                 html.Br(),
+                html.H4("Seed Set"),
+                dcc.Checklist(
+                    id='multi-select',
+                    options=[
+                        {'label': 'Clicks add or remove seeds', 'value': 'multi-select'}
+                    ],
+                    value=[],
+                    labelStyle={'display': 'block'}
+                ),
+                dcc.Input(
+                    id='seed-text-ids',
+                    type='text',
+                    placeholder='Seed text ids, e.g. 1_1, 2_5',
+                    debounce=True
+                ),
+                dcc.RadioItems(
+                    id='seed-combine',
+                    options=[
+                        {'label': 'Closest to the centroid', 'value': 'centroid'},
+                        {'label': 'Closest to any seed (max)', 'value': 'max'}
+                    ],
+                    value='centroid',
+                    labelStyle={'display': 'block'}
+                ),
+                html.Button('Clear Seeds', id='clear-seeds-button'),
                 html.Br(),
-                html.Button('Toggle Selection', id='clear-selection-button')
+                html.H4("Search"),
+                dcc.Input(
+                    id='search-input',
+                    type='text',
+                    placeholder='Search texts',
+                    debounce=True
+                ),
+                html.Div(id='search-output')
             ],
             style={'width': '13%', 'display': 'inline-block', 'vertical-align': 'top', 'margin-left': '15px'}
         ),
@@ -100,66 +586,176 @@ app.layout = html.Div([
             html.H4('Hover Data'),
             html.Div(id='hovered-point-output'),
             html.Br(),
-            html.Div(id='clicked-point-output')
+            html.Progress(id='similarity-progress', value='0', max='1', style={'visibility': 'hidden'}),
+            html.Div(id='clicked-point-output', children=html.P("Click on a point to see its most similar texts."))
         ], style={'width': '34%', 'display': 'inline-block', 'vertical-align': 'top', 'margin-left': '15px'}),
 
         dcc.Store(id='plot-state'),
+        dcc.Store(id='lod-view'),
+        dcc.Store(id='base-figure'),
+        dcc.Store(id='expanded-clusters'),
+        dcc.Store(id='seed-rows', data=[]),
+        dcc.Store(id='selected-rows', data=[]),
+        dcc.Interval(id='dataset-poll', interval=dataset_poll_seconds * 1000),
 
     ])
 ])
 
 
-@app.callback(
-    Output('scatter-plot', 'figure'),
-    [Input('tooltip-toggle', 'value'),
-     Input('page-input', 'value'),
-     Input('scatter-plot', 'clickData'),
-     Input('clear-selection-button', 'n_clicks'),
-     Input('similarity-threshold', 'value')],
-    [State('scatter-plot', 'relayoutData')]
-)
-def update_scatter_plot(show_text, page_number, click_data, clear_selection_clicks, similarity_threshold, scatter_relayout_data):
+def get_hover_template(show_text):
     # Creating the hover template based on the checkbox value
     hover_template = 'X: %{x}<br>Y: %{y}<br>Z: %{z}<br>'
 
-    # Filter the data based on the entered page number
-    if page_number:
-        filtered_df = df[df['page'] == page_number]
-    else:
-        filtered_df = df
-
     if 'show-text' in show_text:
-        hover_template += 'Page: %{customdata}<br>Text: %{text}'
-        customdata = filtered_df['page']
+        hover_template += 'Page: %{marker.color}<br>Text: %{text}'
     else:
-        hover_template += 'Text ID: %{customdata}'
-        customdata = filtered_df['text_id']
-
+        hover_template += 'Text ID: %{hovertext}'
 
     # Update the hover template
     hover_template += '<extra></extra>'
 
-    # Create the scatter plot
+    return hover_template
+
+
+def get_shown_rows(page_number, camera, keep=()):
+    # Rows of the page, decimated to the camera view when there are too many to draw
+    rows = get_page_rows(page_number)
+    if rows is None:
+        rows = slice(0, n_rows)
+    if row_count(rows, n_rows) > lod_max_points:
+        # neighbours found on other pages are only drawn by the overlay
+        keep = np.asarray(keep, dtype=np.int64)
+        keep = keep[in_scope(keep, rows)]
+        rows = lod.sample_rows(row_array(rows, n_rows), coordinates, camera, lod_max_points, keep)
+    return rows
+
+
+def is_cluster_page(page_number):
+    # Whether the page is large enough to be shown as clusters at overview zoom
+    return store.cluster_labels is not None and row_count(get_page_rows(page_number), n_rows) > cluster_overview_min_points
+
+
+def show_clusters(page_number, camera):
+    return lod.view_key(camera) == 0 and is_cluster_page(page_number)
+
+
+def get_expanded_clusters(expanded_clusters, page_number):
+    # Clusters expanded on the shown page, the expanded-clusters store holds {'page', 'clusters'}
+    if expanded_clusters is None or expanded_clusters['page'] != page_number:
+        return []
+    return expanded_clusters['clusters']
+
+
+def get_cluster_rows(page_number, expanded):
+    # Points of the expanded clusters of the page, decimated when there are too many to draw
+    if len(expanded) == 0:
+        return np.empty(0, dtype=np.int64)
+    rows = get_page_rows(page_number)
+    rows = row_array(slice(0, n_rows) if rows is None else rows, n_rows)
+    rows = rows[np.isin(store.cluster_labels[rows], expanded)]
+    if len(rows) > lod_max_points:
+        rows = lod.sample_rows(rows, coordinates, None, lod_max_points)
+    return rows
+
+
+def get_base_trace_data(rows, show_text):
+    # Per point arrays of the base trace, customdata holds the row. Texts are only
+    # sent for the text tooltip, the hover panel reads them by row
+    # rows is a slice for a whole page, so the columns are views. customdata is a
+    # JSON list so click and hover events carry it (see with_customdata)
+    return dict(
+        x=typed_array(coordinates[rows, 0], np.float32),
+        y=typed_array(coordinates[rows, 1], np.float32),
+        z=typed_array(coordinates[rows, 2], np.float32),
+        marker_color=typed_array(pages[rows], page_dtype),
+        text=texts[rows] if 'show-text' in (show_text or []) else None,
+        hovertext=text_ids[rows],
+        customdata=row_array(rows, n_rows).tolist(),
+    )
+
+
+# Traces after the base trace, they are always present (empty when unused)
+# so their callbacks can replace them by position. Points appended while a
+# session is open are added as further traces from first_delta_trace on
+overlay_trace = 1
+search_trace = 2
+cluster_trace = 3
+first_delta_trace = 4
+
+
+def empty_trace(name):
+    return go.Scatter3d(x=[], y=[], z=[], mode='markers', name=name, showlegend=False)
+
+
+def build_points_trace(rows, show_text):
+    # Points coloured by page, the colour scale is shared by the base and delta traces
+    trace_data = get_base_trace_data(rows, show_text)
     trace = go.Scatter3d(
-        x=filtered_df['0'],
-        y=filtered_df['1'],
-        z=filtered_df['2'],
+        x=trace_data['x'],
+        y=trace_data['y'],
+        z=trace_data['z'],
         mode='markers',
         marker=dict(
             size=point_size,
-            color=filtered_df['page'],
-            colorscale='Viridis',
+            color=trace_data['marker_color'],
+            coloraxis='coloraxis',
             opacity=0.8
         ),
-        text=filtered_df['text'],
-        hovertemplate=hover_template,
-        customdata=customdata,
+        text=trace_data['text'],
+        hovertext=trace_data['hovertext'],
+        hovertemplate=get_hover_template(show_text),
         name='',
+        showlegend=False,
     )
+    return with_customdata(trace, trace_data['customdata'])
+
+
+def build_cluster_trace(page_number):
+    # One marker per cluster of the page at the mean position of its points, sized by their number
+    rows = get_page_rows(page_number)
+    if rows is None:
+        rows = slice(0, n_rows)
+    labels = np.asarray(store.cluster_labels[rows])
+    sizes = np.bincount(labels, minlength=len(store.cluster_centroids))
+    clusters = np.flatnonzero(sizes)
+    if len(clusters) == 0:
+        return empty_trace('Clusters')
+    points = np.asarray(coordinates[rows])
+    positions = np.column_stack([np.bincount(labels, weights=points[:, i], minlength=len(sizes))[clusters]
+                                 for i in range(3)]) / sizes[clusters, np.newaxis]
+    sizes = sizes[clusters]
 
-    layout = go.Layout(scene=dict(aspectmode='cube'))
+    trace = go.Scatter3d(
+        x=typed_array(positions[:, 0], np.float32),
+        y=typed_array(positions[:, 1], np.float32),
+        z=typed_array(positions[:, 2], np.float32),
+        mode='markers',
+        marker=dict(
+            size=typed_array(point_size + (cluster_max_marker_size - point_size) * np.sqrt(sizes / sizes.max()),
+                             np.float32),
+            color=typed_array(clusters, smallest_int_dtype(clusters)),
+            colorscale='Turbo',
+            opacity=0.6
+        ),
+        hovertext=[f'Cluster {cluster}: {size} points' for cluster, size in zip(clusters, sizes)],
+        hovertemplate='%{hovertext}<br>Click to expand<extra></extra>',
+        name='Clusters',
+        showlegend=False,
+    )
+    return with_customdata(trace, -1 - clusters)
 
-    fig = go.Figure(data=[trace], layout=layout)
+
+def build_base_figure(rows, show_text, clusters=None):
+    # Create the scatter plot, clusters is the cluster trace at overview zoom of large pages
+    trace = build_points_trace(rows, show_text)
+
+    # a constant uirevision keeps the camera on the client across figure updates
+    layout = go.Layout(scene=dict(aspectmode='cube'), uirevision='scatter-plot',
+                       coloraxis=dict(colorscale='Viridis', showscale=False))
+
+    # the point and cluster traces are dicts (see with_customdata), they are added to the
+    # finished figure so plotly doesn't validate them again
+    fig = go.Figure(layout=layout)
 
     # Update the layout to remove the axes ticks and gridlines
     fig.update_layout(scene=dict(xaxis=dict(showgrid=False, showticklabels=False),
@@ -189,104 +785,254 @@ def update_scatter_plot(show_text, page_number, click_data, clear_selection_clic
         zaxis=dict(showspikes=False)
     ))
 
-    # Get clicked point index
-    clicked_index = None
-    if click_data is not None:
-        print(click_data)
-        clicked_index = click_data['points'][0]['pointNumber']
+    figure = fig.to_plotly_json()
+    figure['data'] = [trace, empty_trace('Most similar').to_plotly_json(), empty_trace('Search matches').to_plotly_json(),
+                      clusters if clusters is not None else empty_trace('Clusters').to_plotly_json()]
+    return figure
+
+
+def get_selection(click_data, scope, query, progress=None, seeds=None, combine='centroid'):
+    # Returns (clicked_row, similar_rows, similarity_scores), None when nothing is selected.
+    # With seed rows the first item is the array of seeds instead of the clicked row
+    if query is None:
+        return None
+    if seeds:
+        most_similars, similarity_scores = get_seed_neighbours(seeds, combine, scope, query)
+        return np.asarray(seeds), most_similars, similarity_scores
+    if click_data is None:
+        return None
+
+    clicked_row = get_clicked_row(click_data)
+    if clicked_row is None:
+        return None
+    most_similars, similarity_scores = get_neighbours(clicked_row, scope, query, progress)
+    return clicked_row, most_similars, similarity_scores
+
+
+def build_overlay_trace(selection):
+    # One segment trace from the clicked point to each of its most similar points,
+    # segments are separated by NaN so a single trace holds any number of them
+    # A seed set starts every segment at the mean position of the seeds, which
+    # are drawn as single points (seed, gap) after the segments
+    if selection is None or len(selection[1]) == 0:
+        return empty_trace('Most similar')
+    clicked_row, most_similars, similarity_scores = selection
+    seeds = np.atleast_1d(clicked_row)
+    origin = coordinates[seeds].mean(axis=0)
+
+    # (clicked point, similar point, gap) for every segment
+    segments = np.full((len(most_similars), 3, 3), np.nan)
+    segments[:, 0] = origin
+    segments[:, 1] = coordinates[most_similars]
+    segments = segments.reshape(-1, 3)
+
+    colors = np.full((len(most_similars), 3), np.nan)
+    colors[:, 0] = 1
+    colors[:, 1] = similarity_scores
+    colors = colors.ravel()
+
+    labels = np.empty((len(most_similars), 3), dtype=object)
+    labels[:, 0] = text_ids[clicked_row] if len(seeds) == 1 else f'{len(seeds)} seeds'
+    labels[:, 1] = [f'{text_id} - {score:.2f}' for text_id, score in zip(text_ids[most_similars], similarity_scores)]
+    labels[:, 2] = ''
+
+    # row and page of every point, -1 for the gaps
+    row_ids = np.full((len(most_similars), 3), -1)
+    row_ids[:, 0] = seeds[0] if len(seeds) == 1 else -1
+    row_ids[:, 1] = most_similars
+    row_ids = row_ids.ravel()
+
+    if len(seeds) > 1:
+        seed_points = np.full((len(seeds), 2, 3), np.nan)
+        seed_points[:, 0] = coordinates[seeds]
+        seed_labels = np.empty((len(seeds), 2), dtype=object)
+        seed_labels[:, 0] = [f'{text_id} (seed)' for text_id in text_ids[seeds]]
+        seed_labels[:, 1] = ''
+        seed_rows = np.full((len(seeds), 2), -1)
+        seed_rows[:, 0] = seeds
+        segments = np.concatenate([segments, seed_points.reshape(-1, 3)])
+        colors = np.concatenate([colors, np.tile([1, np.nan], len(seeds))])
+        labels = np.concatenate([labels.ravel(), seed_labels.ravel()])
+        row_ids = np.concatenate([row_ids, seed_rows.ravel()])
+    trace = go.Scatter3d(
+        x=typed_array(segments[:, 0], np.float32),
+        y=typed_array(segments[:, 1], np.float32),
+        z=typed_array(segments[:, 2], np.float32),
+        mode='lines+markers',
+        line=dict(color='orange', width=1),
+        marker=dict(
+            size=point_size,
+            color=typed_array(colors, np.float32),
+            colorscale='Oranges',
+            cmin=float(similarity_scores.min()),
+            cmax=1,
+            opacity=0.8
+        ),
+        hovertext=np.ravel(labels),
+        hovertemplate='%{hovertext}<extra></extra>',
+        connectgaps=False,
+        name='Most similar',
+        showlegend=False,
+    )
 
-        # Compute cosine similarity with clicked point
-        similarities = cosine_similarity([filtered_df.iloc[clicked_index][['0', '1', '2']]], filtered_df[['0', '1', '2']])
-        similarities = similarities.flatten()
+    return with_customdata(trace, row_ids)
 
-        # sort similarities by descending order
-        most_similar_index = np.argsort(similarities)[::-1]
 
-        # keep only the top n
-        most_similars = most_similar_index[1:similarity_threshold + 1]
+def build_search_trace(rows):
+    # Search matches drawn over the base trace
+    if len(rows) == 0:
+        return empty_trace('Search matches')
+    trace = go.Scatter3d(
+        x=typed_array(coordinates[rows, 0], np.float32),
+        y=typed_array(coordinates[rows, 1], np.float32),
+        z=typed_array(coordinates[rows, 2], np.float32),
+        mode='markers',
+        marker=dict(size=point_size + 2, color='red', opacity=0.9),
+        hovertext=text_ids[rows],
+        hovertemplate='Match: %{hovertext}<extra></extra>',
+        name='Search matches',
+        showlegend=False,
+    )
+    return with_customdata(trace, rows)
 
-        # add most similar points to the plot
-        if similarity_threshold > 0:
-            for i in most_similars:
-                color = similarities[i]
-                fig.add_trace(
-                    go.Scatter3d(
-                        x=[filtered_df.iloc[clicked_index]['0'], filtered_df.iloc[i]['0']],
-                        y=[filtered_df.iloc[clicked_index]['1'], filtered_df.iloc[i]['1']],
-                        z=[filtered_df.iloc[clicked_index]['2'], filtered_df.iloc[i]['2']],
-                        mode='markers',
-                        marker=dict(
-                            size=point_size,
-                            color=color,
-                            colorscale='Oranges',
-                            opacity=0.8
-                        ),
-                        name=filtered_df.iloc[i]['text_id'] + ' - ' + str(round(similarities[i], 2)),
-                    )
-                )
-                similar_texts = filtered_df.iloc[most_similars]['text']
-                similarity_scores = similarities[most_similars]
-                print(similar_texts)
-                print(similarity_scores)
 
-            # Create a list to hold the colors for each point
-            colors = ['gray'] * len(filtered_df)
+def get_camera(plot_state):
+    if plot_state is not None:
+        return plot_state.get('scene.camera')
+    return None
+
 
-            # Set the color of the selected point to 'Oranges'
-            colors[clicked_index] = 'red'
+def selected_rows(selection):
+    # The clicked point and its neighbours are always drawn at full detail
+    if selection is None:
+        return []
+    return np.append(selection[1], selection[0]).tolist()
 
-            # Set the color of the most similar points to 'Oranges'
-            for i in most_similars:
-                colors[i] = 'blue'
 
-            # # Update the color property of the marker object with the colors list
-            # trace.marker.color = colors
+def patch_base_trace(patched_figure, rows, show_text):
+    # Replaces the points of the base trace by rows
+    for key, value in get_base_trace_data(rows, show_text).items():
+        if key == 'marker_color':
+            patched_figure['data'][0]['marker']['color'] = value
+        else:
+            patched_figure['data'][0][key] = value
+
+
+# The figure is only rebuilt when the page changes or the text tooltip is turned on
+# (texts are only sent for it), turning the tooltip off only patches the hover template
+# and a camera move only patches the base trace arrays when the level of detail
+# changes. The rebuilt figure has empty overlay and search traces so the response
+# can be shared by every session (see base_figure_key),
+# writing base-figure then lets update_clicked_point_output and update_search fill them.
+# The rows kept at full detail come from selected-rows, written with the overlay, since
+# the neighbours may have been computed by a background job in another process.
+# Large clustered pages start with the cluster markers only at overview zoom and
+# update_clusters adds the points of the clusters expanded in the session.
+# The camera itself is kept by plotly through the layout uirevision
+@app.callback(
+    [Output('scatter-plot', 'figure'),
+     Output('lod-view', 'data'),
+     Output('base-figure', 'data')],
+    [Input('tooltip-toggle', 'value'),
+     Input('page-input', 'value'),
+     Input('plot-state', 'data')],
+    [State('lod-view', 'data'),
+     State('base-figure', 'data'),
+     State('expanded-clusters', 'data'),
+     State('selected-rows', 'data')]
+)
+@instrument('update_scatter_plot')
+def update_scatter_plot(show_text, page_number, plot_state, lod_view, base_figure, expanded_clusters, selection_rows):
+    triggered_id = ctx.triggered_id
+    camera = get_camera(plot_state)
+
+    # tooltip turned off, only the hover template of the base and delta traces is sent.
+    # Turning it on rebuilds the figure below since the traces have no texts yet
+    if triggered_id == 'tooltip-toggle' and 'show-text' not in show_text:
+        patched_figure = Patch()
+        delta_traces = base_figure['delta_traces'] if base_figure else 0
+        for i in [0] + list(range(first_delta_trace, first_delta_trace + delta_traces)):
+            patched_figure['data'][i]['hovertemplate'] = get_hover_template(show_text)
+        return patched_figure, no_update, no_update
+
+    # camera move, the base trace is only resent when the level of detail changes
+    # and the cluster markers when zooming in or back out to the overview
+    if triggered_id == 'plot-state':
+        view = lod.view_key(camera)
+        cluster_page = is_cluster_page(page_number)
+        if (row_count(get_page_rows(page_number), n_rows) <= lod_max_points and not cluster_page) or view == lod_view:
+            return no_update, no_update, no_update
+
+        patched_figure = Patch()
+        if show_clusters(page_number, camera):
+            patched_figure['data'][cluster_trace] = build_cluster_trace(page_number)
+            patch_base_trace(patched_figure, get_cluster_rows(
+                page_number, get_expanded_clusters(expanded_clusters, page_number)), show_text)
+            return patched_figure, view, no_update
+
+        if cluster_page:
+            patched_figure['data'][cluster_trace] = empty_trace('Clusters')
+        patch_base_trace(patched_figure, get_shown_rows(page_number, camera, selection_rows or []), show_text)
+        return patched_figure, view, no_update
+
+    # first render or page change, the full figure is built from the inputs only
+    fig, base_figure = build_page_figure(page_number, camera, show_text)
+    return fig, lod.view_key(camera), base_figure
+
+
+def build_page_figure(page_number, camera, show_text):
+    # Returns the base figure of a page and its base-figure data
+    version = dataset_version
+    if show_clusters(page_number, camera):
+        fig = build_base_figure(get_cluster_rows(page_number, []), show_text, build_cluster_trace(page_number))
+    else:
+        fig = build_base_figure(get_shown_rows(page_number, camera), show_text)
+    return fig, {'version': version, 'page': page_number, 'delta_traces': 0}
 
-            # Update the colorscale property of the marker object
-            trace.marker.colorscale = [[0, 'gray'], [1, 'red']]
 
+scatter_plot_callback = build_request_body(app, 'scatter-plot.figure', {}, [])['output']
 
-    if clear_selection_clicks is not None:
-        if clear_selection_clicks % 2 == 1:
-            fig.data = [fig.data[0]]
 
-    # Update the layout based on the relayout data
-    if scatter_relayout_data is not None:
-        if 'scene.camera' in scatter_relayout_data:
-            fig.update_layout(scene_camera=scatter_relayout_data['scene.camera'])
+def base_figure_key(body):
+    # Cache key of a request rebuilding the base figure, None for the patches.
+    # Every page render counts as a view of its page, except the pre-warming ones
+    if body.get('output') != scatter_plot_callback:
+        return None
+    changed = [prop.split('.')[0] for prop in body.get('changedPropIds') or []]
+    values = request_values(body)
+    show_text = 'show-text' in (values.get('tooltip-toggle.value') or [])
+    if 'plot-state' in changed or ('tooltip-toggle' in changed and not show_text):
+        return None
 
-    # Restore scatter plot zoom and position data
-        if scatter_relayout_data is not None:
-            scatter_relayout_data['autosize'] = True
+    page_number = values.get('page-input.value')
+    if 'tooltip-toggle' not in changed and not is_warm_request():
+        page_views.add(page_number)
+    view = lod.view_key(get_camera(values.get('plot-state.data')))
+    return dataset_version, json.dumps(page_number), show_text, json.dumps(view)
 
-    return fig
 
+init_figure_cache(app.server, figure_cache, base_figure_key)
 
 
 # Callback function to update the right sidebar output
 @app.callback(
     Output('hovered-point-output', 'children'),
-    [Input('scatter-plot', 'hoverData')],
-    [State('scatter-plot', 'relayoutData')]
+    [Input('scatter-plot', 'hoverData')]
 )
-def update_hovered_point_output(hover_data, scatter_relayout_data):
+@instrument('update_hovered_point_output')
+def update_hovered_point_output(hover_data):
     if hover_data is not None:
         point_data = hover_data['points'][0]
         x, y, z = point_data['x'], point_data['y'], point_data['z']
-        # if point_data has text
-        if 'text' in point_data:
-            text_value = point_data['text']
-            text_id = df.loc[df['text'] == text_value, 'text_id'].values[0]
-            page = df.loc[df['text'] == text_value, 'page'].values[0]
+        # points carry their row position as customdata, -1 for overlay gaps
+        customdata = point_data.get('customdata')
+        if customdata is not None and customdata >= 0:
+            text_id, text_value, page = get_record(int(customdata))
         else:
             text_value, text_id, page = None, None, None
     else:
         x, y, z, text_value, text_id, page = None, None, None, None, None, None
 
-    # Restore scatter plot zoom and position data
-    if scatter_relayout_data is not None:
-        scatter_relayout_data['autosize'] = True
-
     if x is not None and y is not None and z is not None and text_value is not None:
         return html.Div([
             html.P(f"Text ID: {text_id}"),
@@ -302,93 +1048,328 @@ def update_hovered_point_output(hover_data, scatter_relayout_data):
         return html.P("Hover over a point to see its details.")
 
 
-# Callback function to update the right sidebar output
-@app.callback(
-    Output('clicked-point-output', 'children'),
-    [Input('scatter-plot', 'clickData'),
-     Input('similarity-threshold', 'value')],
-    [State('scatter-plot', 'relayoutData')]
-)
 # In this function we need to get n number all of most similar texts from and update the clicked point output
 # text_id - text - similarity score
-def update_clicked_point_output(click_data, similarity_threshold, scatter_relayout_data):
-    if click_data is not None:
-        clicked_index = click_data['points'][0]['pointNumber']
-        print(df)
-        print(df.iloc[clicked_index])
-        print(df.iloc[clicked_index][['0', '1', '2']])
-
-        # Compute cosine similarity with clicked point
-        similarities = cosine_similarity([df.iloc[clicked_index][['0', '1', '2']]], df[['0', '1', '2']])
-        similarities = similarities.flatten()
-
-        # sort similarities by descending order
-        most_similar_index = np.argsort(similarities)[::-1]
-
-        # keep only the top n
-        most_similars = most_similar_index[1:similarity_threshold + 1]
+# The neighbours are computed once per click for both the side panel and the overlay
+# traces after data[0], set_progress is None unless it runs as a background job.
+# A new base figure (page change) re-runs it so the overlay is drawn again, for the scope of the new page
+def update_clicked_point_output(set_progress, click_data, similarity_threshold, similarity_mode, score_cutoff,
+                                scope_mode, scope_pages, clear_selection_clicks, base_figure, seed_rows, seed_combine,
+                                page_number, multi_select):
+    # clicks on cluster markers are handled by update_clusters, clicks adding seeds by update_seed_rows
+    # which runs this again once the seed set changed
+    if ctx.triggered_id == 'scatter-plot' and (get_clicked_cluster(click_data) is not None
+                                               or 'multi-select' in (multi_select or [])):
+        return no_update, no_update, no_update
+
+    progress = None
+    if set_progress is not None:
+        def progress(done, total):
+            set_progress((str(done), str(total)))
+
+    # The toggle button hides the selection on odd clicks
+    show_selection = clear_selection_clicks is None or clear_selection_clicks % 2 == 0
+    query = get_query(similarity_mode, similarity_threshold, score_cutoff)
+    scope = get_scope(scope_mode, page_number, scope_pages)
+    selection = get_selection(click_data, scope, query, progress, seed_rows, seed_combine)
+
+    # only the overlay trace is replaced, the rows it shows are kept for update_scatter_plot
+    shown = selection if show_selection else None
+    patched_figure = Patch()
+    patched_figure['data'][overlay_trace] = build_overlay_trace(shown)
+
+    if ctx.triggered_id == 'clear-selection-button':
+        return no_update, patched_figure, selected_rows(shown)
+
+    if seed_rows or (click_data is not None and get_clicked_row(click_data) is not None):
+        most_similars, similarity_scores = selection[1:] if selection else ([], [])
 
         # prepare most similar texts and similarity scores
-        similar_texts = df.iloc[most_similars]['text']
-        similarity_scores = similarities[most_similars]
-        print("Similar texts and similarity scores")
-        print(similar_texts)
-        print("Similar texts and similarity scores")
-        print(similarity_scores)
+        similar_texts = texts[most_similars[:panel_max_results]]
 
         # prepare output
         output = []
         # add title
         output.append(html.H4("Most similar texts:"))
-        # clicked text
-        output.append(html.P(f"Clicked text: {df.iloc[clicked_index]['text']}"))
+        # clicked text, or the seed set
+        if seed_rows:
+            closest_to = 'their centroid' if seed_combine == 'centroid' else 'any of them'
+            seed_ids = ', '.join(text_ids[seed_rows[:panel_max_results]])
+            output.append(html.P(f"{len(seed_rows)} seeds, closest to {closest_to}: {seed_ids}"))
+            output.append(html.P("A click outside multi-select mode clears the seeds."))
+        else:
+            output.append(html.P(f"Clicked text: {texts[get_clicked_row(click_data)]}"))
         # show small title for most similar texts
-        output.append(html.P("Most similar texts:"))
-        # add most similar texts and similarity scores
+        if query is not None and query[0] == 'cutoff':
+            capped = ' (capped)' if len(most_similars) >= score_cutoff_max_results else ''
+            output.append(html.P(f"{len(most_similars)}{capped} texts with a similarity of at least {query[1]}:"))
+        else:
+            output.append(html.P("Most similar texts:"))
+        # add most similar texts and similarity scores, long results are cut in the panel
         for i in range(len(similar_texts)):
-            print(similar_texts.iloc[i])
-            print(similarity_scores[i])
-            output.append(html.P(f"{similar_texts.iloc[i]} - {similarity_scores[i]}"))
+            output.append(html.P(f"{similar_texts[i]} - {similarity_scores[i]}"))
+        if len(most_similars) > panel_max_results:
+            output.append(html.P(f"... and {len(most_similars) - panel_max_results} more, shown in the plot"))
+
+    else:
+        output = html.P("Click on a point to see its most similar texts.")
 
-        # Restore scatter plot zoom and position data
-        if scatter_relayout_data is not None:
-            scatter_relayout_data['autosize'] = True
-            # scatter_relayout_data['uirevision'] = True
-            # scatter_relayout_data['xaxis.autorange'] = False
-            # scatter_relayout_data['yaxis.autorange'] = False
-            # scatter_relayout_data['zaxis.autorange'] = False
-            # scatter_relayout_data['scene.xaxis.range'] = [df['0'].min(), df['0'].max()]
+    return output, patched_figure, selected_rows(shown)
 
 
-        return output
+clicked_point_callback = (
+    [Output('clicked-point-output', 'children'),
+     Output('scatter-plot', 'figure', allow_duplicate=True),
+     Output('selected-rows', 'data')],
+    [Input('scatter-plot', 'clickData'),
+     Input('similarity-threshold', 'value'),
+     Input('similarity-mode', 'value'),
+     Input('similarity-cutoff', 'value'),
+     Input('similarity-scope', 'value'),
+     Input('scope-pages', 'value'),
+     Input('clear-selection-button', 'n_clicks'),
+     Input('base-figure', 'data'),
+     Input('seed-rows', 'data'),
+     Input('seed-combine', 'value')],
+    [State('page-input', 'value'),
+     State('multi-select', 'value')],
+)
 
+if background_callback_manager is not None:
+    app.callback(
+        *clicked_point_callback,
+        prevent_initial_call=True,
+        background=True,
+        manager=background_callback_manager,
+        progress=[Output('similarity-progress', 'value'), Output('similarity-progress', 'max')],
+        running=[(Output('similarity-progress', 'style'), {'visibility': 'visible'}, {'visibility': 'hidden'})],
+        cancel=[Input('page-input', 'value')],
+    )(instrument('update_clicked_point_output')(update_clicked_point_output))
+else:
+    @app.callback(*clicked_point_callback, prevent_initial_call=True)
+    @instrument('update_clicked_point_output')
+    def update_clicked_point_output_sync(*args):
+        return update_clicked_point_output(None, *args)
+
+
+# Rows appended since the figure was built (or last updated) are added as one more
+# trace with the points of the shown page. A figure built by a worker that has more
+# rows than this one is left as it is. Writing base-figure also refreshes the overlay
+# and search, whose results may include the new rows
+@app.callback(
+    [Output('scatter-plot', 'figure', allow_duplicate=True),
+     Output('base-figure', 'data', allow_duplicate=True)],
+    [Input('dataset-poll', 'n_intervals')],
+    [State('base-figure', 'data'),
+     State('tooltip-toggle', 'value')],
+    prevent_initial_call=True
+)
+@instrument('update_dataset_version')
+def update_dataset_version(n_intervals, base_figure, show_text):
+    version = dataset_version
+    if base_figure is None or base_figure['version'] >= version:
+        return no_update, no_update
+
+    new_rows = np.arange(base_figure['version'], version)
+    if base_figure['page']:
+        new_rows = new_rows[pages[new_rows] == base_figure['page']]
+    base_figure = {**base_figure, 'version': version}
+    if len(new_rows) == 0:
+        return no_update, base_figure
+
+    patched_figure = Patch()
+    patched_figure['data'].append(build_points_trace(new_rows, show_text))
+    base_figure['delta_traces'] += 1
+    return patched_figure, base_figure
+
+
+# The seed set is a sorted list of rows. In multi-select mode a click on a point adds
+# it or removes it again, a list of text ids replaces the set. A plain click (or a
+# search result button) selects its point alone, so it clears the set
+@app.callback(
+    Output('seed-rows', 'data'),
+    [Input('scatter-plot', 'clickData'),
+     Input('seed-text-ids', 'value'),
+     Input('clear-seeds-button', 'n_clicks')],
+    [State('multi-select', 'value'),
+     State('seed-rows', 'data')],
+    prevent_initial_call=True
+)
+@instrument('update_seed_rows')
+def update_seed_rows(click_data, seed_text_ids, clear_seeds_clicks, multi_select, seed_rows):
+    if ctx.triggered_id == 'clear-seeds-button':
+        return []
+    if ctx.triggered_id == 'seed-text-ids':
+        rows = get_rows_of_text_ids(parse_text_ids(seed_text_ids))
+        return sorted(set(rows[rows >= 0].tolist()))
+
+    row = get_clicked_row(click_data) if click_data is not None else None
+    if row is None:
+        return no_update
+    if 'multi-select' not in (multi_select or []):
+        return [] if seed_rows else no_update
+    return sorted(set(seed_rows or []) ^ {row})
+
+
+# A click on a cluster marker expands the cluster into its points, drawn in the base
+# trace, a second click collapses it. A new base figure of the same page (e.g. after
+# the tooltip mode changed) gets the points of the expanded clusters again
+@app.callback(
+    [Output('scatter-plot', 'figure', allow_duplicate=True),
+     Output('expanded-clusters', 'data')],
+    [Input('scatter-plot', 'clickData'),
+     Input('base-figure', 'data')],
+    [State('expanded-clusters', 'data'),
+     State('plot-state', 'data'),
+     State('tooltip-toggle', 'value')],
+    prevent_initial_call=True
+)
+@instrument('update_clusters')
+def update_clusters(click_data, base_figure, expanded_clusters, plot_state, show_text):
+    if base_figure is None or not show_clusters(base_figure['page'], get_camera(plot_state)):
+        return no_update, no_update
+
+    page_number = base_figure['page']
+    expanded = get_expanded_clusters(expanded_clusters, page_number)
+    if ctx.triggered_id == 'scatter-plot':
+        cluster = get_clicked_cluster(click_data)
+        if cluster is None:
+            return no_update, no_update
+        expanded = sorted(set(expanded) ^ {cluster})
+    elif not expanded:
+        return no_update, no_update
+
+    patched_figure = Patch()
+    patch_base_trace(patched_figure, get_cluster_rows(page_number, expanded), show_text)
+    return patched_figure, {'page': page_number, 'clusters': expanded}
+
+
+# Matches within the shown page are highlighted and the first ones listed as buttons
+# that select their point like a click, so a match can seed the similarity query.
+# A new base figure starts with an empty search trace, so the search is run again
+@app.callback(
+    [Output('search-output', 'children'),
+     Output('scatter-plot', 'figure', allow_duplicate=True)],
+    [Input('search-input', 'value'),
+     Input('base-figure', 'data')],
+    [State('page-input', 'value')],
+    prevent_initial_call=True
+)
+@instrument('update_search')
+def update_search(query, base_figure, page_number):
+    if not query and ctx.triggered_id == 'base-figure':
+        return no_update, no_update
+
+    patched_figure = Patch()
+    if not query:
+        patched_figure['data'][search_trace] = empty_trace('Search matches')
+        return None, patched_figure
+
+    with metrics.timer('search.seconds'):
+        matches = get_text_index().search(query, get_page_rows(page_number))
+    patched_figure['data'][search_trace] = build_search_trace(matches[:search_max_points])
+
+    if len(matches) > search_max_points:
+        output = [html.P(f"{len(matches)} matches, the first {search_max_points} are shown")]
     else:
-        return html.P("Click on a point to see its most similar texts.")
+        output = [html.P(f"{len(matches)} matches")]
+    for row in matches[:search_panel_results]:
+        output.append(html.Button(f"{text_ids[row]}: {texts[row][:80]}", id={'type': 'search-result', 'index': int(row)},
+                                  style={'display': 'block', 'width': '100%', 'text-align': 'left'}))
+    return output, patched_figure
 
 
-# Callback function to update plot state on zoom or pan events
 @app.callback(
+    Output('scatter-plot', 'clickData'),
+    [Input({'type': 'search-result', 'index': ALL}, 'n_clicks')],
+    prevent_initial_call=True
+)
+@instrument('select_search_result')
+def select_search_result(result_clicks):
+    # Same click data as a click on the point, which triggers update_clicked_point_output
+    if not ctx.triggered_id or not ctx.triggered[0]['value']:
+        return no_update
+    row = ctx.triggered_id['index']
+    x, y, z = (float(v) for v in coordinates[row])
+    return {'points': [{'x': x, 'y': y, 'z': z, 'customdata': row}]}
+
+
+# Keep the camera in plot-state on the client, it is only written when the camera
+# moves far enough to change the level of detail (same rule as lod.view_key), so
+# plain rotations and zooms don't reach the server
+app.clientside_callback(
+    """
+    function(relayoutData, plotState) {
+        if (!relayoutData || !relayoutData['scene.camera']) {
+            return window.dash_clientside.no_update;
+        }
+        var camera = relayoutData['scene.camera'];
+        var view = 0;
+        if (camera.eye) {
+            var center = camera.center || {x: 0, y: 0, z: 0};
+            var dx = camera.eye.x - center.x, dy = camera.eye.y - center.y, dz = camera.eye.z - center.z;
+            var distance = Math.sqrt(dx * dx + dy * dy + dz * dz);
+            var level = distance > 0 ? Math.floor(Math.log2(%(default_eye_distance)r / distance)) : %(max_level)d;
+            level = Math.min(Math.max(level, 0), %(max_level)d);
+            if (level > 0) {
+                var step = %(focus_radius)r / Math.pow(2, level) / 2;
+                view = [level, Math.round(center.x / step), Math.round(center.y / step), Math.round(center.z / step)];
+            }
+        }
+        if (plotState && JSON.stringify(plotState.view) === JSON.stringify(view)) {
+            return window.dash_clientside.no_update;
+        }
+        return {'scene.camera': camera, 'view': view};
+    }
+    """ % {'default_eye_distance': float(lod.default_eye_distance), 'max_level': lod.max_level,
+           'focus_radius': lod.focus_radius},
     Output('plot-state', 'data'),
-    [Input('scatter-plot', 'relayoutData')]
+    [Input('scatter-plot', 'relayoutData')],
+    [State('plot-state', 'data')]
 )
-def update_plot_state(relayout_data):
-    return relayout_data
 
 
-# Restoring the plot state after the function is processed
-@app.callback(
-    Output('scatter-plot', 'relayoutData'),
-    [Input('clicked-point-output', 'children')],
-    [State('plot-state', 'data')]  # Retrieve plot state data
-)
-def restore_plot_state(children, plot_state):
-    if plot_state is not None:
-        return plot_state
-    else:
-        return {}
+def prewarm_figure_cache():
+    # Build the base figures of the most viewed pages of previous runs in both tooltip modes
+    bodies = [build_request_body(app, 'scatter-plot.figure',
+                                 {'page-input.value': page_number, 'tooltip-toggle.value': show_text},
+                                 ['page-input.value'])
+              for page_number in page_views.most_viewed(prewarm_pages) for show_text in ([], ['show-text'])]
+    warm(app, bodies)
+
+
+def load_indexes():
+    similarity_engine.load_index()
+    get_text_index()
+
+
+if startup_mode == 'eager':
+    load_indexes()
+
+# Threads started by the first request of the process rather than at import: under
+# gunicorn --preload the workers would be forked while they hold the index or figure
+# cache locks, which then stay locked in every worker
+startup_threads = []
+if startup_mode == 'background':
+    startup_threads.append(('load-indexes', load_indexes))
+if page_views_path and prewarm_pages:
+    startup_threads.append(('prewarm-figure-cache', prewarm_figure_cache))
+startup_lock = threading.Lock()
+
+
+@app.server.before_request
+def start_startup_threads():
+    global startup_threads
+    if not startup_threads:
+        return
+    with startup_lock:
+        threads, startup_threads = startup_threads, []
+    for name, target in threads:
+        threading.Thread(target=target, name=name, daemon=True).start()
 
 
 # Running the Dash application
 if __name__ == '__main__':
+    logging.basicConfig(level=os.environ.get('EXPLORER_LOG_LEVEL', 'WARNING'))
     print("Running...")
     app.run_server(debug=True)
@@ -0,0 +1,146 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import flask
+import numpy as np
+
+logger = logging.getLogger('explorer.metrics')
+
+# number of most recent samples kept for every metric
+window_size = 1000
+
+# level of the structured log line written for every callback
+log_level = logging.getLevelName(os.environ.get('EXPLORER_METRICS_LOG_LEVEL', 'DEBUG'))
+
+
+class RollingHistogram:
+    """The last ``window_size`` samples of a metric."""
+
+    def __init__(self, size=window_size):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        if not self.samples:
+            return {'count': self.count}
+        samples = np.fromiter(self.samples, dtype=float)
+        p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+        return {'count': self.count, 'mean': self.total / self.count, 'p50': p50, 'p90': p90, 'p99': p99,
+                'max': float(samples.max())}
+
+
+class Metrics:
+    """Thread safe set of named rolling histograms."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = RollingHistogram()
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+
+metrics = Metrics()
+
+
+def _request_state():
+    # Per request values shared by the callback wrapper and the Flask hooks
+    if flask.has_request_context():
+        return flask.g
+    return None
+
+
+def instrument(name):
+    """Record the wall time of a Dash callback as ``callback.<name>.seconds``.
+
+    Place it under ``@app.callback`` so the instrumented function is the one
+    registered.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                metrics.observe(f'callback.{name}.seconds', elapsed)
+                state = _request_state()
+                if state is not None:
+                    state.metrics_callback = name
+                    state.metrics_callback_seconds = elapsed
+
+        return wrapper
+
+    return decorator
+
+
+def init_metrics(server, route='/metrics'):
+    """Time Dash update requests on ``server`` and serve the metrics on ``route``.
+
+    For every ``_dash-update-component`` request the response size and the
+    time spent outside the callback (mostly serialising the output) are
+    recorded, and one JSON log line is written at ``log_level``. The route
+    only answers requests from the local host.
+    """
+
+    @server.before_request
+    def start_timer():
+        flask.g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        if not flask.request.path.endswith('_dash-update-component') or 'metrics_start' not in flask.g:
+            return response
+
+        elapsed = time.perf_counter() - flask.g.metrics_start
+        name = flask.g.get('metrics_callback', 'unknown')
+        callback_seconds = flask.g.get('metrics_callback_seconds', 0.0)
+        payload_bytes = response.calculate_content_length() or 0
+
+        metrics.observe(f'request.{name}.seconds', elapsed)
+        metrics.observe(f'request.{name}.serialization_seconds', elapsed - callback_seconds)
+        metrics.observe(f'request.{name}.bytes', payload_bytes)
+        if logger.isEnabledFor(log_level):
+            logger.log(log_level, json.dumps({
+                'callback': name,
+                'seconds': round(elapsed, 6),
+                'callback_seconds': round(callback_seconds, 6),
+                'bytes': payload_bytes,
+                'status': response.status_code,
+            }))
+        return response
+
+    @server.route(route)
+    def metrics_endpoint():
+        if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+            flask.abort(403)
+        return metrics.snapshot()
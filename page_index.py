@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class PageIndex:
+    """Offsets of every page in rows sorted by page.
+
+    A single page or a range of consecutive pages is a contiguous block of
+    rows, so it is returned as a ``slice`` and indexing arrays with it gives a
+    view instead of a copy.
+
+    Rows appended after the sorted block (see ``append``) are kept as a
+    separate list sorted by page. Pages that have some are returned as a
+    sorted array of row positions instead of a slice.
+    """
+
+    def __init__(self, pages):
+        pages = np.asarray(pages)
+        # rows after the first page decrease were appended later
+        decreases = np.flatnonzero(pages[1:] < pages[:-1])
+        n_sorted = int(decreases[0]) + 1 if len(decreases) else len(pages)
+        self.pages, self.starts, counts = np.unique(pages[:n_sorted], return_index=True, return_counts=True)
+        self.stops = self.starts + counts
+        self.extra_pages = np.empty(0, dtype=pages.dtype)
+        self.extra_rows = np.empty(0, dtype=np.int64)
+        self.n_rows = n_sorted
+        self.append(pages[n_sorted:])
+
+    def __len__(self):
+        return len(np.union1d(self.pages, self.extra_pages))
+
+    def append(self, pages):
+        """Add rows with the given pages after the current last row."""
+        pages = np.asarray(pages)
+        extra_pages = np.concatenate([self.extra_pages, pages])
+        extra_rows = np.concatenate([self.extra_rows, np.arange(self.n_rows, self.n_rows + len(pages))])
+        order = np.argsort(extra_pages, kind='stable')
+        self.extra_pages, self.extra_rows = extra_pages[order], extra_rows[order]
+        self.n_rows += len(pages)
+
+    def with_extra_rows(self, rows, first, last):
+        # rows plus the appended rows of the pages from first to last
+        start = np.searchsorted(self.extra_pages, first, side='left')
+        stop = np.searchsorted(self.extra_pages, last, side='right')
+        if start >= stop:
+            return rows
+        return np.sort(np.concatenate([np.arange(rows.start, rows.stop), self.extra_rows[start:stop]]))
+
+    def page_count(self, page):
+        """Number of rows of ``page``."""
+        return row_count(self.page_slice(page), self.n_rows)
+
+    def page_slice(self, page):
+        """Rows of ``page``, an empty slice when the page does not exist."""
+        rows = slice(0, 0)
+        i = np.searchsorted(self.pages, page)
+        if i < len(self.pages) and self.pages[i] == page:
+            rows = slice(int(self.starts[i]), int(self.stops[i]))
+        return self.with_extra_rows(rows, page, page)
+
+    def range_slice(self, first, last):
+        """Rows of every page from ``first`` to ``last`` inclusive."""
+        rows = slice(0, 0)
+        start = np.searchsorted(self.pages, first, side='left')
+        stop = np.searchsorted(self.pages, last, side='right')
+        if start < stop:
+            rows = slice(int(self.starts[start]), int(self.stops[stop - 1]))
+        return self.with_extra_rows(rows, first, last)
+
+    def select(self, pages):
+        """Rows of a page, a ``(first, last)`` range or a list of pages.
+
+        Single pages and ranges give a slice (unless they have appended rows),
+        lists give a sorted array of row positions.
+        """
+        if isinstance(pages, tuple):
+            return self.range_slice(*pages)
+        if isinstance(pages, (list, set, np.ndarray)):
+            rows = [row_array(self.page_slice(page), self.n_rows) for page in sorted(set(pages))]
+            if not rows:
+                return np.empty(0, dtype=np.int64)
+            return np.sort(np.concatenate(rows))
+        return self.page_slice(pages)
+
+
+def row_array(rows, n_rows):
+    """Row positions selected by ``rows`` (None, a slice, a boolean mask or an array) as an array."""
+    if rows is None:
+        return np.arange(n_rows)
+    if isinstance(rows, slice):
+        return np.arange(*rows.indices(n_rows))
+    if np.asarray(rows).dtype == bool:
+        return np.flatnonzero(rows)
+    return rows
+
+
+def row_count(rows, n_rows):
+    """Number of rows selected by ``rows`` (None, a slice, a boolean mask or an array)."""
+    if rows is None:
+        return n_rows
+    if isinstance(rows, slice):
+        return len(range(*rows.indices(n_rows)))
+    if np.asarray(rows).dtype == bool:
+        return int(np.count_nonzero(rows))
+    return len(rows)
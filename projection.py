@@ -0,0 +1,77 @@
+import hashlib
+import os
+
+import numpy as np
+
+# rows read at a time, the embeddings never have to fit in memory at once
+batch_size = 65536
+
+def dataset_hash(embeddings):
+    """Hash of the shape, dtype and every row, read ``batch_size`` rows at a time.
+
+    A sample of rows misses edits between the sampled ones, which would reuse
+    the projection of the old data.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((embeddings.shape, str(embeddings.dtype))).encode())
+    for start in range(0, len(embeddings), batch_size):
+        digest.update(np.ascontiguousarray(embeddings[start:start + batch_size]).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def fit_pca(embeddings, n_components=3):
+    from sklearn.decomposition import IncrementalPCA
+
+    pca = IncrementalPCA(n_components=n_components)
+    for start in range(0, len(embeddings), batch_size):
+        batch = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+        # the last batch may be too small for partial_fit
+        if len(batch) >= n_components:
+            pca.partial_fit(batch)
+    return pca.transform
+
+
+def fit_random_projection(embeddings, n_components=3, seed=0):
+    matrix = np.random.default_rng(seed).normal(size=(embeddings.shape[1], n_components)).astype(np.float32)
+    matrix /= np.sqrt(n_components)
+    return lambda batch: batch @ matrix
+
+
+reducers = {
+    'pca': fit_pca,
+    'random': fit_random_projection,
+}
+
+
+def project(embeddings, method='pca', cache_dir=None):
+    """3D layout of ``embeddings`` (an array or memory mapped .npy).
+
+    The reducer is fitted and applied in batches. When ``cache_dir`` is given
+    the result is stored there under the dataset hash and reused, memory
+    mapped, on the next call with the same data.
+    """
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, f'projection-{method}-{dataset_hash(embeddings)}.npy')
+        if os.path.exists(cache_path):
+            return np.load(cache_path, mmap_mode='r')
+
+    transform = reducers[method](embeddings)
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        coordinates = np.lib.format.open_memmap(cache_path + '.tmp', mode='w+', dtype=np.float32,
+                                                shape=(len(embeddings), 3))
+    else:
+        coordinates = np.empty((len(embeddings), 3), dtype=np.float32)
+
+    for start in range(0, len(embeddings), batch_size):
+        batch = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+        coordinates[start:start + batch_size] = transform(batch)
+
+    if cache_path:
+        coordinates.flush()
+        del coordinates
+        # only a complete file is ever found under the cache name
+        os.replace(cache_path + '.tmp', cache_path)
+        return np.load(cache_path, mmap_mode='r')
+    return coordinates
@@ -0,0 +1,679 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from page_index import row_array, row_count
+
+
+# number of k-means iterations used to train the approximate index
+ivf_train_iterations = 10
+
+# number of rows sampled to train the approximate index
+ivf_train_sample = 100000
+
+# rows scanned between two progress reports
+scan_chunk_rows = 100000
+
+# quantised rows converted to float32 at a time while scanning
+quantized_chunk_rows = 16384
+
+# a quantised scan keeps this many candidates per result for the exact re-rank
+rerank_factor = 4
+
+# rows scored at a time against a block of queries by batch_top_k
+batch_chunk_rows = 16384
+
+# rows of an array scope gathered at a time by an exact scan
+gather_chunk_rows = 16384
+
+# range queries scan the scope as it is when the index keeps more than this fraction of it
+range_scan_fraction = 0.5
+
+
+def normalize_rows(vectors):
+    """Return a float32 copy of ``vectors`` with every row scaled to unit length."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[np.newaxis, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def select_top_k(scores, k):
+    """Positions of the ``k`` largest ``scores``, best first.
+
+    Uses a partial selection so the cost is O(N + k log k) instead of a full sort.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(scores, -k)[-k:]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(scores[top])[::-1]]
+
+
+def quantize(vectors, dtype):
+    """Return ``(codes, scales)`` of unit length ``vectors`` stored as ``dtype``.
+
+    float16 codes are the vectors themselves with no scales. int8 codes are
+    every vector divided by its own float32 scale, so the largest component
+    maps to 127.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == 'float16':
+        return vectors.astype(np.float16), None
+    if dtype != 'int8':
+        raise ValueError(f'unknown quantization {dtype!r}, use float16 or int8')
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.rint(vectors / scales[:, np.newaxis]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class QuantizedVectors:
+    """Low precision copy of the vectors, for a first pass scan.
+
+    ``codes`` and ``scales`` are as returned by ``quantize`` (and may be
+    memory mapped). float16 codes take half the memory of float32 vectors,
+    int8 codes with their scales about a quarter.
+    """
+
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_vectors(cls, vectors, dtype, batch_size=65536):
+        codes = np.empty(vectors.shape, dtype=np.float16 if dtype == 'float16' else np.int8)
+        scales = np.empty(len(vectors), dtype=np.float32) if dtype == 'int8' else None
+        for start in range(0, len(vectors), batch_size):
+            batch_codes, batch_scales = quantize(vectors[start:start + batch_size], dtype)
+            codes[start:start + batch_size] = batch_codes
+            if scales is not None:
+                scales[start:start + batch_size] = batch_scales
+        return cls(codes, scales)
+
+    @property
+    def dtype(self):
+        return 'float16' if self.codes.dtype == np.float16 else 'int8'
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def scores(self, query, rows):
+        """Approximate similarity of ``query`` to ``rows`` (a slice or an array of row positions)."""
+        if isinstance(rows, slice):
+            rows = range(*rows.indices(len(self.codes)))
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), quantized_chunk_rows):
+            chunk = rows[start:start + quantized_chunk_rows]
+            if isinstance(chunk, range):
+                chunk = slice(chunk.start, chunk.stop)
+            chunk_scores = self.codes[chunk].astype(np.float32) @ query
+            if self.scales is not None:
+                chunk_scores *= self.scales[chunk]
+            scores[start:start + len(chunk_scores)] = chunk_scores
+        return scores
+
+    def dequantize(self, rows):
+        """Approximate float32 vectors of ``rows`` (a slice or an array of row positions)."""
+        vectors = self.codes[rows].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, np.newaxis]
+        return vectors
+
+
+def in_scope(candidates, rows):
+    """Which ``candidates`` (row positions) are in the scope ``rows``.
+
+    A scope is None (every row), a slice, a boolean mask over all rows or an
+    array of row positions. Slices and masks are checked in constant time per
+    candidate.
+    """
+    if rows is None:
+        return np.ones(len(candidates), dtype=bool)
+    if isinstance(rows, slice):
+        return (candidates >= (rows.start or 0)) & (rows.stop is None or candidates < rows.stop)
+    rows = np.asarray(rows)
+    if rows.dtype == bool:
+        return rows[candidates]
+    return np.isin(candidates, rows)
+
+
+class IVFIndex:
+    """Inverted-file index: vectors are bucketed by their nearest k-means centroid
+    and a query only scans the ``n_probe`` closest buckets.
+
+    Every bucket also keeps its angular radius (the largest angle between the
+    centroid and a member), which lets range queries skip the buckets that
+    can't hold a match. Bucket members are stored as one array ``order``
+    sorted by bucket, bucket ``c`` being ``order[offsets[c]:offsets[c + 1]]``.
+    """
+
+    file_names = ['ivf_centroids.npy', 'ivf_order.npy', 'ivf_offsets.npy', 'ivf_radii.npy']
+
+    def __init__(self, centroids, order, offsets, radii, n_probe=8):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.radii = radii
+        self.n_probe = n_probe
+
+    @classmethod
+    def train(cls, vectors, n_lists, n_probe=8, seed=0):
+        """Train ``n_lists`` k-means centroids on (a sample of) ``vectors`` and bucket every vector."""
+        rng = np.random.default_rng(seed)
+        n_lists = max(1, min(n_lists, len(vectors)))
+
+        # train the centroids on a sample of the (unit length) vectors
+        sample = vectors
+        if len(vectors) > ivf_train_sample:
+            sample = vectors[rng.choice(len(vectors), ivf_train_sample, replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(ivf_train_iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = normalize_rows(centroids)
+        index = cls(centroids, np.empty(0, dtype=np.int64), np.zeros(n_lists + 1, dtype=np.int64),
+                    np.zeros(n_lists, dtype=np.float32), n_probe)
+
+        # bucket every vector, stored as one sorted array plus offsets
+        assignment, similarity = index.assign(vectors)
+        index.order = np.argsort(assignment, kind='stable')
+        index.offsets = np.searchsorted(assignment[index.order], np.arange(n_lists + 1))
+
+        # every member lies within this angle of its centroid
+        min_similarity = np.ones(n_lists, dtype=np.float32)
+        np.minimum.at(min_similarity, assignment, similarity)
+        index.radii = np.arccos(np.clip(min_similarity, -1, 1))
+        return index
+
+    @classmethod
+    def open(cls, path, n_probe=8):
+        return cls(*(np.load(os.path.join(path, name)) for name in cls.file_names), n_probe=n_probe)
+
+    def save(self, path):
+        # every file is moved into place whole, workers opening the store meanwhile
+        # either see it or train their own
+        for name, values in zip(self.file_names, (self.centroids, self.order, self.offsets, self.radii)):
+            temporary = os.path.join(path, f'{name}.{os.getpid()}.tmp.npy')
+            np.save(temporary, values)
+            os.replace(temporary, os.path.join(path, name))
+
+    def __len__(self):
+        return len(self.order)
+
+    def assign(self, vectors, batch_size=65536):
+        """Return ``(bucket, similarity to its centroid)`` of every vector."""
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        similarity = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), batch_size):
+            scores = vectors[start:start + batch_size] @ self.centroids.T
+            assignment[start:start + batch_size] = np.argmax(scores, axis=1)
+            similarity[start:start + batch_size] = scores[np.arange(len(scores)), assignment[start:start + batch_size]]
+        return assignment, similarity
+
+    def add(self, vectors, start):
+        """Bucket rows ``start:start + len(vectors)``, added after the index was trained."""
+        assignment, similarity = self.assign(vectors)
+        order = np.argsort(assignment, kind='stable')
+        assignment, similarity = assignment[order], similarity[order]
+
+        # every new row goes at the end of its bucket
+        counts = np.bincount(assignment, minlength=len(self.centroids))
+        order = np.insert(self.order, self.offsets[assignment + 1], order + start)
+        offsets = self.offsets + np.concatenate([[0], np.cumsum(counts)])
+        np.maximum.at(self.radii, assignment, np.arccos(np.clip(similarity, -1, 1)))
+        self.order, self.offsets = order, offsets
+
+    def candidates(self, query):
+        """Row ids stored in the ``n_probe`` buckets closest to ``query``."""
+        lists = select_top_k(self.centroids @ query, self.n_probe)
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists])
+
+    def range_candidates(self, query, min_score):
+        """Row ids of every bucket that may hold a vector with ``query @ vector >= min_score``.
+
+        A member is at most the bucket radius further from the query than the
+        centroid (triangle inequality on the sphere), so the other buckets are
+        skipped without missing any match.
+        """
+        angles = np.arccos(np.clip(self.centroids @ query, -1, 1))
+        # small slack for float32 rounding
+        lists = np.flatnonzero(angles - self.radii <= np.arccos(np.clip(min_score, -1, 1)) + 1e-4)
+        if len(lists) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists])
+
+
+def load_or_build_index(path, vectors, n_lists, n_probe=8):
+    """Open the IVF index saved in ``path``, or train it on ``vectors`` and save it there.
+
+    Rows of ``vectors`` beyond the saved index are added to it. With no
+    ``path`` (or a read only one) the index is only kept in memory.
+    """
+    if path and all(os.path.exists(os.path.join(path, name)) for name in IVFIndex.file_names):
+        index = IVFIndex.open(path, n_probe)
+        if len(index) < len(vectors):
+            index.add(vectors[len(index):], len(index))
+        return index
+
+    index = IVFIndex.train(vectors, n_lists, n_probe)
+    if path:
+        try:
+            index.save(path)
+        except OSError as error:
+            logging.getLogger(__name__).warning('similarity index not saved to %s: %s', path, error)
+    return index
+
+
+class SimilarityEngine:
+    """Cosine top-k search over a fixed set of embeddings.
+
+    The embedding matrix is normalised once, so every query is a single
+    matrix-vector product followed by a partial selection. Pass
+    ``normalized=True`` for float32 unit length vectors (e.g. a memory mapped
+    store) to use them without a copy.
+
+    ``graph`` is an optional ``(indices, scores)`` pair of precomputed
+    neighbours per row (see knn_graph.py), best first. Queries it can answer
+    exactly are a lookup instead of a scan. Rows added with ``extend`` after
+    the graph was built are scored directly and merged in.
+
+    ``quantized`` is an optional ``QuantizedVectors`` copy of the vectors.
+    Scans then score the quantised rows and only the best ``rerank_factor``
+    candidates per result are scored exactly, so a memory mapped ``vectors``
+    is only read for those rows.
+
+    The approximate index (``n_lists`` buckets) is loaded from or saved to
+    ``index_path`` when given. With ``lazy=True`` it is only opened or
+    trained by the first query that uses it, so creating the engine is free.
+    """
+
+    def __init__(self, embeddings, n_lists=0, n_probe=8, normalized=False, graph=None, quantized=None,
+                 index_path=None, lazy=False):
+        self.vectors = np.asarray(embeddings) if normalized else normalize_rows(embeddings)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.index_path = index_path
+        self.index_lock = threading.Lock()
+        self._index = None
+        self.graph = graph
+        self.quantized = quantized
+        if not lazy:
+            self.load_index()
+
+    @property
+    def index(self):
+        """The approximate index, None when the engine has none."""
+        if self._index is None and self.n_lists:
+            self.load_index()
+        return self._index
+
+    def load_index(self):
+        """Open or train the approximate index, if it hasn't been already."""
+        with self.index_lock:
+            if self._index is None and self.n_lists:
+                self._index = load_or_build_index(self.index_path, self.vectors, self.n_lists, self.n_probe)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def extend(self, vectors, quantized=None):
+        """Search ``vectors``, the current vectors followed by new rows.
+
+        The new rows are added to the buckets of the approximate index, which
+        is not retrained. ``quantized`` replaces the quantised vectors, when
+        the engine uses them.
+        """
+        with self.index_lock:
+            start = len(self.vectors)
+            self.vectors = np.asarray(vectors)
+            if quantized is not None:
+                self.quantized = quantized
+            # an index not loaded yet is built from every row
+            if self._index is not None:
+                self._index.add(self.vectors[start:], start)
+
+    def scores(self, row, rows=None):
+        """Cosine similarity of ``row`` against every row (or only ``rows``).
+
+        Rows given as an array or a mask are gathered ``gather_chunk_rows`` at
+        a time rather than copied all at once.
+        """
+        query = self.vectors[row]
+        if rows is None or isinstance(rows, slice):
+            return (self.vectors if rows is None else self.vectors[rows]) @ query
+        rows = row_array(rows, len(self.vectors))
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), gather_chunk_rows):
+            scores[start:start + gather_chunk_rows] = self.vectors[rows[start:start + gather_chunk_rows]] @ query
+        return scores
+
+    def scan_scores(self, row, rows):
+        """``scores`` for a scan, from the quantised vectors when there are some."""
+        if self.quantized is None:
+            return self.scores(row, rows)
+        return self.quantized.scores(np.asarray(self.vectors[row], dtype=np.float32), rows)
+
+    def rerank(self, row, candidates, k):
+        """The best ``k`` of ``candidates`` by their exact scores."""
+        # sorted reads are much faster on a memory mapped file
+        candidates = np.sort(candidates)
+        scores = self.scores(row, candidates)
+        top = select_top_k(scores, k)
+        return candidates[top], scores[top]
+
+    def top_k(self, row, k, rows=None, progress=None):
+        """Return ``(indices, scores)`` of the ``k`` rows most similar to ``row``.
+
+        ``row`` itself is excluded. ``rows`` optionally restricts the search to
+        a scope (a slice, a boolean mask or an array of row positions, see
+        ``in_scope``); returned indices are always global positions. A slice is
+        scanned in place without copying the vectors.
+
+        The approximate index answers unrestricted searches, and scoped ones
+        when the scope is larger than the probed buckets and holds at least
+        ``k`` of their rows, so a small scope (one page) is scanned exactly and
+        a large one costs no more than the whole corpus.
+        ``progress(done, total)`` is called while a slice is scanned.
+        With quantised vectors the scan is a first pass re-ranked exactly.
+        """
+        neighbours = self.graph_top_k(row, k, rows)
+        if neighbours is not None:
+            return neighbours
+
+        if self.index is not None:
+            candidates = self.index.candidates(self.vectors[row])
+            if rows is None:
+                rows = candidates
+            elif row_count(rows, len(self.vectors)) > len(candidates):
+                candidates = candidates[in_scope(candidates, rows)]
+                if len(candidates) >= k:
+                    rows = candidates
+        return self.exact_top_k(row, k, rows, progress)
+
+    def exact_top_k(self, row, k, rows=None, progress=None):
+        """``top_k`` scanning every row of the scope, without the approximate index."""
+        if rows is None:
+            rows = slice(0, len(self.vectors))
+        first_pass_k = k if self.quantized is None else k * rerank_factor
+        if isinstance(rows, slice):
+            start, stop, _ = rows.indices(len(self.vectors))
+            indices, scores = self.scan_top_k(row, first_pass_k, start, stop, progress)
+        else:
+            rows = np.asarray(row_array(rows, len(self.vectors)), dtype=np.int64)
+            rows = rows[rows != row]
+            scores = self.scan_scores(row, rows)
+            top = select_top_k(scores, first_pass_k)
+            indices, scores = rows[top], scores[top]
+
+        if self.quantized is None:
+            return indices, scores
+        return self.rerank(row, indices, k)
+
+    def range_query(self, row, min_score, max_results, rows=None, progress=None):
+        """Return ``(indices, scores)`` of the rows with a similarity of at least ``min_score`` to ``row``.
+
+        Results are best first and capped at the ``max_results`` best. The
+        graph answers when its last neighbour of ``row`` scores below the
+        cutoff, otherwise the approximate index prunes the buckets that can't
+        match and the rest is scanned, so the result is exact either way.
+        ``rows`` and ``progress`` are as for ``top_k``.
+        """
+        neighbours = self.graph_range(row, min_score, max_results, rows)
+        if neighbours is not None:
+            return neighbours
+
+        if self.index is not None:
+            candidates = self.index.range_candidates(self.vectors[row], min_score)
+            candidates = candidates[in_scope(candidates, rows)]
+            # a loose cutoff keeps most buckets, the scope is then scanned as it is
+            if len(candidates) <= range_scan_fraction * row_count(rows, len(self.vectors)):
+                rows = candidates
+
+        # the best max_results rows hold every match within the cap. The candidates are
+        # scanned as they are, probing fewer buckets than they span would miss matches
+        indices, scores = self.exact_top_k(row, max_results, rows=rows, progress=progress)
+        keep = scores >= min_score
+        return indices[keep], scores[keep]
+
+    def batch_top_k(self, queries, k, rows=None, exclude=None):
+        """Return ``(indices, scores)`` of the ``k`` rows most similar to every query, as (n, k) arrays.
+
+        ``queries`` are unit length vectors. Every block of
+        ``batch_chunk_rows`` rows is scored against all of them with one
+        matrix product, on the quantised vectors followed by an exact re-rank
+        when the engine has them. ``rows`` is a scope as for ``top_k``,
+        ``exclude`` optionally the row to leave out for every query (-1 for
+        none). Missing results, when the scope holds fewer rows, score -inf.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        first_pass_k = k if self.quantized is None else k * rerank_factor
+
+        best_indices = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for chunk, chunk_rows in self.scope_chunks(rows):
+            scores = queries @ self.chunk_vectors(chunk).T
+            if exclude is not None:
+                scores[chunk_rows[np.newaxis, :] == np.asarray(exclude)[:, np.newaxis]] = -np.inf
+
+            # keep the best of this block and the previous ones
+            best_indices = np.concatenate([best_indices, np.broadcast_to(chunk_rows, scores.shape)], axis=1)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            if best_scores.shape[1] > first_pass_k:
+                keep = np.argpartition(best_scores, -first_pass_k, axis=1)[:, -first_pass_k:]
+                best_indices = np.take_along_axis(best_indices, keep, axis=1)
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+
+        # one query at a time with its candidates read in row order, as in rerank, so only
+        # the vectors of one query's candidates are in memory
+        if self.quantized is not None and best_indices.size:
+            for i, query in enumerate(queries):
+                order = np.argsort(best_indices[i], kind='stable')
+                candidates, missing = best_indices[i, order], best_scores[i, order] == -np.inf
+                exact = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+                best_indices[i], best_scores[i] = candidates, np.where(missing, -np.inf, exact)
+
+        order = np.argsort(-best_scores, axis=1)[:, :k]
+        return np.take_along_axis(best_indices, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def multi_top_k(self, seeds, k, combine='centroid', rows=None):
+        """Return ``(indices, scores)`` of the ``k`` rows most similar to a set of ``seeds`` (row positions).
+
+        With ``combine='centroid'`` a row scores its similarity to the mean
+        of the seeds, with ``'max'`` its highest similarity to any seed. Both
+        take one pass over the rows, every block scored against all seeds
+        with one matrix product. The seeds themselves are excluded and
+        ``rows`` is a scope as for ``top_k``.
+        """
+        seeds = np.unique(np.asarray(seeds, dtype=np.int64))
+        seed_vectors = np.asarray(self.vectors[seeds], dtype=np.float32)
+        if combine == 'centroid':
+            indices, scores = self.batch_top_k(normalize_rows(seed_vectors.mean(axis=0)), k + len(seeds), rows)
+            keep = ~np.isin(indices[0], seeds) & (scores[0] > -np.inf)
+            return indices[0][keep][:k], scores[0][keep][:k]
+        if combine != 'max':
+            raise ValueError(f'unknown combine {combine!r}, use centroid or max')
+
+        first_pass_k = k if self.quantized is None else k * rerank_factor
+        best_indices = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for chunk, chunk_rows in self.scope_chunks(rows):
+            scores = (seed_vectors @ self.chunk_vectors(chunk).T).max(axis=0)
+            scores[np.isin(chunk_rows, seeds)] = -np.inf
+            best_indices = np.concatenate([best_indices, chunk_rows])
+            best_scores = np.concatenate([best_scores, scores])
+            top = select_top_k(best_scores, first_pass_k)
+            best_indices, best_scores = best_indices[top], best_scores[top]
+
+        keep = best_scores > -np.inf
+        best_indices = best_indices[keep]
+        if self.quantized is not None:
+            best_indices = np.sort(best_indices)
+            best_scores = (seed_vectors @ np.asarray(self.vectors[best_indices], dtype=np.float32).T).max(axis=0)
+        else:
+            best_scores = best_scores[keep]
+        top = select_top_k(best_scores, k)
+        return best_indices[top], best_scores[top]
+
+    def scope_chunks(self, rows):
+        """``(chunk, chunk_rows)`` blocks of ``batch_chunk_rows`` rows of the scope ``rows``.
+
+        ``chunk`` indexes the vectors (a slice when possible), ``chunk_rows``
+        holds its row positions.
+        """
+        if rows is None:
+            rows = slice(0, len(self.vectors))
+        if isinstance(rows, slice):
+            start, stop, _ = rows.indices(len(self.vectors))
+            for chunk_start in range(start, stop, batch_chunk_rows):
+                chunk_stop = min(chunk_start + batch_chunk_rows, stop)
+                yield slice(chunk_start, chunk_stop), np.arange(chunk_start, chunk_stop)
+        else:
+            positions = np.asarray(row_array(rows, len(self.vectors)), dtype=np.int64)
+            for chunk_start in range(0, len(positions), batch_chunk_rows):
+                chunk = positions[chunk_start:chunk_start + batch_chunk_rows]
+                yield chunk, chunk
+
+    def chunk_vectors(self, chunk):
+        """float32 vectors of ``chunk`` for a scan, dequantised when the engine has quantised vectors."""
+        if self.quantized is not None:
+            return self.quantized.dequantize(chunk)
+        return np.asarray(self.vectors[chunk], dtype=np.float32)
+
+    def scan_top_k(self, row, k, start, stop, progress=None):
+        """``top_k`` over rows ``start:stop``, in chunks when reporting progress."""
+        chunk_rows = scan_chunk_rows if progress is not None else max(stop - start, 1)
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+
+        for chunk_start in range(start, stop, chunk_rows):
+            chunk_stop = min(chunk_start + chunk_rows, stop)
+            scores = self.scan_scores(row, slice(chunk_start, chunk_stop))
+            if chunk_start <= row < chunk_stop:
+                scores[row - chunk_start] = -np.inf
+            top = select_top_k(scores, k)
+
+            # merge with the best rows of the previous chunks
+            best_rows = np.concatenate([best_rows, top + chunk_start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            top = select_top_k(best_scores, k)
+            best_rows, best_scores = best_rows[top], best_scores[top]
+
+            if progress is not None:
+                progress(chunk_stop - start, stop - start)
+
+        keep = best_rows != row
+        return best_rows[keep], best_scores[keep]
+
+    def graph_top_k(self, row, k, rows=None):
+        """``top_k`` from the precomputed graph, None when it can't answer exactly.
+
+        The graph holds the best K neighbours over all rows. Those that fall in
+        ``rows`` are also the best within ``rows``, so the answer is exact as
+        long as at least ``k`` of them do.
+        """
+        if self.graph is None:
+            return None
+        indices, scores = self.graph
+        if k > indices.shape[1] or row >= len(indices):
+            return None
+
+        neighbours = np.asarray(indices[row], dtype=np.int64)
+        keep = np.flatnonzero(in_scope(neighbours, rows))[:k]
+
+        neighbours = neighbours[keep]
+        if len(neighbours) < k:
+            return None
+        return self.with_appended(row, k, rows, neighbours, np.asarray(scores[row][keep], dtype=np.float32))
+
+    def graph_range(self, row, min_score, max_results, rows=None):
+        """``range_query`` from the precomputed graph, None when it can't answer exactly.
+
+        Every row scoring at least ``min_score`` is in the graph when the last
+        stored neighbour of ``row`` scores below it. Graph scores are float16.
+        """
+        if self.graph is None:
+            return None
+        indices, scores = self.graph
+        if row >= len(indices):
+            return None
+        neighbour_scores = np.asarray(scores[row], dtype=np.float32)
+        if indices.shape[1] < len(indices) - 1 and (len(neighbour_scores) == 0 or neighbour_scores[-1] >= min_score):
+            return None
+
+        neighbours = np.asarray(indices[row], dtype=np.int64)
+        keep = np.flatnonzero((neighbour_scores >= min_score) & in_scope(neighbours, rows))[:max_results]
+        return self.with_appended(row, max_results, rows, neighbours[keep], neighbour_scores[keep], min_score)
+
+    def with_appended(self, row, k, rows, neighbours, scores, min_score=-np.inf):
+        """Best ``k`` of graph ``neighbours`` and the rows added after the graph (within ``rows``)."""
+        appended = np.arange(len(self.graph[0]), len(self.vectors))
+        appended = appended[in_scope(appended, rows) & (appended != row)]
+        if len(appended) == 0:
+            return neighbours, scores
+
+        appended_scores = self.scores(row, appended)
+        keep = appended_scores >= min_score
+        neighbours = np.concatenate([neighbours, appended[keep]])
+        scores = np.concatenate([scores, appended_scores[keep]])
+        top = select_top_k(scores, k)
+        return neighbours[top], scores[top]
+
+
+class NeighbourCache:
+    """Thread safe LRU cache of neighbour results.
+
+    Keys are whatever identifies a query (e.g. ``(row, page, k)``); values are
+    stored read-only so callers can share them without copying.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        value = compute()
+        for array in value:
+            if isinstance(array, np.ndarray):
+                array.setflags(write=False)
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                    'max_entries': self.max_entries}
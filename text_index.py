@@ -0,0 +1,167 @@
+"""Inverted index from word tokens to the rows whose text contains them.
+
+    python text_index.py STORE_DIR
+
+Tokens are lower case runs of word characters. The vocabulary is stored
+sorted, like a text column, with the rows of every token as one sorted run in
+a single postings array, so a lookup is a binary search and a query of several
+tokens an intersection of sorted arrays. Saved next to an embedding store as
+``search_tokens.bin``, ``search_token_offsets.npy``, ``search_postings.npy``
+and ``search_posting_offsets.npy``, all memory mapped when opened, with the
+number of indexed texts in ``search_index.json``. Texts added later are
+indexed in memory as separate segments.
+"""
+import argparse
+import bisect
+import json
+import logging
+import os
+import re
+from array import array
+
+import numpy as np
+
+from embedding_store import TextColumn, write_texts
+
+token_pattern = re.compile(r'\w+')
+
+file_names = ['search_token_offsets.npy', 'search_tokens.bin', 'search_posting_offsets.npy', 'search_postings.npy',
+              'search_index.json']
+
+
+def tokenize(text):
+    return token_pattern.findall(str(text).lower())
+
+
+class TextIndex:
+    """``tokens`` sorted, the rows of ``tokens[i]`` are ``postings[posting_offsets[i]:posting_offsets[i + 1]]``.
+
+    Rows ``0:n_texts`` are indexed, ``segments`` index the rows appended since.
+    """
+
+    def __init__(self, tokens, posting_offsets, postings, n_texts):
+        self.tokens = tokens
+        self.posting_offsets = posting_offsets
+        self.postings = postings
+        self.n_texts = n_texts
+        self.segments = []
+
+    @classmethod
+    def build(cls, texts, n_texts=None, start=0):
+        """Index rows ``start:n_texts`` of ``texts`` (anything indexable by row, e.g. a TextColumn)."""
+        n_texts = len(texts) if n_texts is None else n_texts
+        vocabulary = {}
+        token_ids, rows = array('i'), array('i')
+        for row in range(start, n_texts):
+            for token in set(tokenize(texts[row])):
+                token_ids.append(vocabulary.setdefault(token, len(vocabulary)))
+                rows.append(row)
+        token_ids = np.frombuffer(token_ids, dtype=np.int32)
+        rows = np.frombuffer(rows, dtype=np.int32)
+
+        # number the tokens in sorted order, rows stay sorted within a token
+        tokens = sorted(vocabulary)
+        rank = np.empty(len(tokens), dtype=np.int64)
+        rank[[vocabulary[token] for token in tokens]] = np.arange(len(tokens))
+        token_ranks = rank[token_ids]
+        order = np.argsort(token_ranks, kind='stable')
+        posting_offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(token_ranks, minlength=len(tokens)), out=posting_offsets[1:])
+        return cls(tokens, posting_offsets, rows[order], n_texts)
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, 'search_index.json')) as f:
+            n_texts = json.load(f)['n_texts']
+        return cls(
+            tokens=TextColumn.open(os.path.join(path, 'search_token_offsets.npy'),
+                                   os.path.join(path, 'search_tokens.bin')),
+            posting_offsets=np.load(os.path.join(path, 'search_posting_offsets.npy'), mmap_mode='r'),
+            postings=np.load(os.path.join(path, 'search_postings.npy'), mmap_mode='r'),
+            n_texts=n_texts,
+        )
+
+    def save(self, path):
+        write_texts(self.tokens, os.path.join(path, 'search_token_offsets.npy'),
+                    os.path.join(path, 'search_tokens.bin'), len(self.tokens))
+        np.save(os.path.join(path, 'search_posting_offsets.npy'), np.asarray(self.posting_offsets, dtype=np.int64))
+        np.save(os.path.join(path, 'search_postings.npy'), np.asarray(self.postings, dtype=np.int32))
+        with open(os.path.join(path, 'search_index.json'), 'w') as f:
+            json.dump({'n_texts': self.n_texts}, f)
+
+    def append(self, texts, stop):
+        """Index rows ``n_texts:stop`` of ``texts`` as a new segment."""
+        self.segments.append(TextIndex.build(texts, stop, self.n_texts))
+        self.n_texts = stop
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def lookup(self, token):
+        """Sorted rows containing ``token``."""
+        i = bisect.bisect_left(self.tokens, token)
+        if i == len(self.tokens) or self.tokens[i] != token:
+            return np.empty(0, dtype=np.int32)
+        return self.postings[self.posting_offsets[i]:self.posting_offsets[i + 1]]
+
+    def search(self, query, rows=None):
+        """Sorted rows whose text contains every token of ``query``.
+
+        ``rows`` optionally restricts the result to a slice (cut out of every
+        posting run by binary search) or an array of row positions.
+        """
+        # segments hold increasing row ranges, so the concatenation stays sorted
+        return np.concatenate([self.search_postings(query, rows)]
+                              + [segment.search_postings(query, rows) for segment in self.segments])
+
+    def search_postings(self, query, rows=None):
+        # search without the segments
+        matches = [self.lookup(token) for token in set(tokenize(query))]
+        if not matches:
+            return np.empty(0, dtype=np.int64)
+
+        if isinstance(rows, slice):
+            start, stop = rows.start or 0, rows.stop
+            matches = [m[np.searchsorted(m, start):len(m) if stop is None else np.searchsorted(m, stop)]
+                       for m in matches]
+
+        # intersect starting from the rarest token
+        matches.sort(key=len)
+        result = np.asarray(matches[0], dtype=np.int64)
+        for other in matches[1:]:
+            if len(result) == 0:
+                break
+            result = result[np.isin(result, other, assume_unique=True)]
+
+        if rows is not None and not isinstance(rows, slice):
+            result = result[np.isin(result, rows)]
+        return result
+
+
+def load_or_build(path, texts):
+    """Open the index saved in ``path``, or build it from ``texts`` and save it there.
+
+    With no ``path`` (or a read only one) the index is only kept in memory.
+    """
+    if path and all(os.path.exists(os.path.join(path, name)) for name in file_names):
+        index = TextIndex.open(path)
+        if index.n_texts < len(texts):
+            index.append(texts, len(texts))
+        return index
+
+    index = TextIndex.build(texts)
+    if path:
+        try:
+            index.save(path)
+        except OSError as error:
+            logging.getLogger(__name__).warning('text index not saved to %s: %s', path, error)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('store')
+    args = parser.parse_args()
+
+    texts = TextColumn.open(os.path.join(args.store, 'text_offsets.npy'), os.path.join(args.store, 'texts.bin'))
+    TextIndex.build(texts).save(args.store)